@@ -39,6 +39,9 @@ _ENV_ACTS_LOGPATH = 'ACTS_LOGPATH'
 _ENV_ACTS_TESTPATHS = 'ACTS_TESTPATHS'
 _PATH_SEPARATOR = ':'
 
+# The max number of test runs executed at the same time in parallel mode.
+_MAX_PARALLEL_TEST_RUNS = 30
+
 
 def _validate_test_config(test_config):
     """Validates the raw configuration loaded from the config file.
@@ -268,7 +271,8 @@ def _gen_term_signal_handler(test_runners):
 
 def _run_tests_parallel(process_args):
     print("Executing {} concurrent test runs.".format(len(process_args)))
-    results = concurrent_exec(_run_test, process_args)
+    results = concurrent_exec(_run_test, process_args,
+                              max_workers=_MAX_PARALLEL_TEST_RUNS)
     for r in results:
         if r is False or isinstance(r, Exception):
             return False
@@ -14,20 +14,47 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from builtins import str
-
+import os
 import random
+import re
+import signal
 import socket
 import subprocess
+import threading
 import time
 
 class AdbError(Exception):
-    """Raised when there is an error in adb operations."""
+    """Raised when there is an error in adb operations.
+
+    Attributes:
+        ret_code: The exit code of the failed command, or None if it did not
+            get to exit, e.g. the adb shell process went away.
+    """
+    def __init__(self, msg, ret_code=None):
+        super(AdbError, self).__init__(msg)
+        self.ret_code = ret_code
+
+# Exit code of a device shell command that was not found.
+SHELL_COMMAND_NOT_FOUND = 127
 
 SL4A_LAUNCH_CMD=("am start -a com.googlecode.android_scripting.action.LAUNCH_SERVER "
     "--ei com.googlecode.android_scripting.extra.USE_SERVICE_PORT {} "
     "com.googlecode.android_scripting/.activity.ScriptingLayerServiceLauncher" )
 
+# Characters that the local shell would interpret in a one-shot "adb shell"
+# command. Commands containing any of these are never sent to a persistent
+# shell, because the device shell would interpret them differently.
+SHELL_SPECIAL_CHARS = frozenset('|&;<>()$`\\"\'*?[#~\n')
+
+# Printed by the persistent shell after each command, followed by the exit
+# code of the command.
+SHELL_EOF_MARKER = "__ACTS_EOF_"
+SHELL_EOF_RE = re.compile(
+    (r"^%s(\d+)__\r?\n$" % SHELL_EOF_MARKER).encode("utf-8"))
+# The adb feature that gives "adb shell" a raw session, without a PTY, when
+# stdin is not a terminal. Both adb and adbd support it from Android N on.
+SHELL_V2_FEATURE = b"shell_v2"
+
 def get_available_host_port():
     """Gets a host port number available for adb forward.
 
@@ -35,9 +62,12 @@ def get_available_host_port():
         An integer representing a port number on the host available for adb
         forward.
     """
+    # The ports used by adb don't change while we look, so only list them
+    # once instead of once per candidate.
+    occupied_ports = set(list_occupied_adb_ports())
     while True:
         port = random.randint(1024, 9900)
-        if is_port_available(port):
+        if port not in occupied_ports and _is_port_bindable(port):
             return port
 
 def is_port_available(port):
@@ -53,6 +83,17 @@ def is_port_available(port):
     # ongoing runs by trying to bind to the port.
     if port in list_occupied_adb_ports():
         return False
+    return _is_port_bindable(port)
+
+def _is_port_bindable(port):
+    """Checks if a given port number can be bound to on the system.
+
+    Args:
+        port: An integer which is the port number to check.
+
+    Returns:
+        True if the port can be bound to; False otherwise.
+    """
     s = None
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -86,6 +127,204 @@ def list_occupied_adb_ports():
         used_ports.append(int(tokens[1]))
     return used_ports
 
+def _kill_process_group(proc):
+    """Kills a process started in its own session, and everything else in
+    its process group.
+
+    Only the process itself is waited for, and its output is discarded, so
+    this returns right away.
+
+    Args:
+        proc: The subprocess.Popen object of the process.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # The process group is already gone.
+        pass
+    proc.wait()
+    if proc.stdout:
+        proc.stdout.close()
+
+class PersistentAdbShell():
+    """A standing "adb shell" process that runs commands one at a time.
+
+    Running a one-shot "adb shell <cmd>" spawns a new adb client and connects
+    to adbd every time. Commands run through this object are written to the
+    stdin of a single adb shell process instead, and each command's output is
+    read back up to a marker carrying its exit code.
+
+    The process is started on the first command, and started again if it has
+    exited, e.g. because the device rebooted.
+
+    This only works with a raw shell session. Older adbd always gives an
+    interactive "adb shell" a PTY, which echoes the commands and prints a
+    prompt into the output, and drops the exit codes of one-shot "adb shell"
+    commands. So the persistent shell is only used if adb and the device
+    support the shell_v2 feature, and a session that turns out to have a PTY
+    is rejected.
+
+    Commands are run one at a time: a long running command, e.g. iperf3 or
+    bugreportz, blocks all the other commands sent to this shell until it
+    finishes. Such commands should be run with a one-shot "adb shell".
+    """
+    def __init__(self, serial="", log=None):
+        self.serial = serial
+        self.log = log
+        self._proc = None
+        self._lock = threading.Lock()
+        self._supported = None
+
+    @property
+    def is_alive(self):
+        """True if the adb shell process is running.
+        """
+        return self._proc is not None and self._proc.poll() is None
+
+    @property
+    def is_supported(self):
+        """True if the device can give the persistent shell a raw session.
+
+        The features of the device are queried the first time, and the answer
+        is kept once it is known. If the query fails while the device is not
+        online, it is asked again next time.
+        """
+        if self._supported is None:
+            try:
+                out = subprocess.check_output(self._adb_cmd("features"))
+            except OSError:
+                # No adb to run at all.
+                self._supported = False
+            except subprocess.CalledProcessError:
+                # If the device is online, adb is too old to know the
+                # command, and asking again won't change that.
+                if self._is_device_online():
+                    self._supported = False
+                return False
+            else:
+                self._supported = SHELL_V2_FEATURE in out.split()
+        return self._supported
+
+    def _adb_cmd(self, *args):
+        cmd = ["adb"]
+        if self.serial:
+            cmd.extend(["-s", str(self.serial)])
+        cmd.extend(args)
+        return cmd
+
+    def _is_device_online(self):
+        try:
+            out = subprocess.check_output(self._adb_cmd("get-state"))
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        return out.strip() == b"device"
+
+    def _start(self):
+        cmd = self._adb_cmd("shell", "-T")
+        self._proc = subprocess.Popen(cmd,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        # A raw session prints exactly what is echoed. A PTY session echoes
+        # the command line first, and ends lines with "\r\n".
+        probe = "{}0__".format(SHELL_EOF_MARKER)
+        try:
+            self._proc.stdin.write("echo {}\n".format(probe).encode("utf-8"))
+            self._proc.stdin.flush()
+            line = self._proc.stdout.readline()
+        except:
+            self.close()
+            raise
+        if not line:
+            # adb shell exited right away, e.g. the device went offline for a
+            # moment after "adb root". Nothing is known about the session.
+            self.close()
+            raise OSError("adb shell of {} exited.".format(self.serial))
+        if line != "{}\n".format(probe).encode("utf-8"):
+            self.close()
+            self._supported = False
+            raise OSError("adb shell of {} is not a raw session, got {}".format(
+                self.serial, line))
+
+    def run(self, command):
+        """Runs a command in the persistent shell.
+
+        The command's stdin is redirected from /dev/null so it cannot consume
+        the commands that follow it.
+
+        Args:
+            command: A string that is the shell command to run on the device.
+
+        Returns:
+            The output of the command if its exit code is 0.
+
+        Raises:
+            AdbError is raised if the exit code is not 0, or if the shell
+            process exited before the command finished.
+            OSError is raised if the device does not support the persistent
+            shell, or if the shell process could not be started or written
+            to. The command has not been run in this case.
+        """
+        if not self.is_supported:
+            raise OSError("{} does not support a persistent adb shell.".format(
+                self.serial))
+        with self._lock:
+            if not self.is_alive:
+                self.close()
+                self._start()
+            line = ("{} < /dev/null; __acts_ret=$?; echo; "
+                    "echo {}${{__acts_ret}}__\n").format(command,
+                                                         SHELL_EOF_MARKER)
+            try:
+                self._proc.stdin.write(line.encode("utf-8"))
+                self._proc.stdin.flush()
+            except OSError:
+                self.close()
+                raise
+            try:
+                out, ret = self._read_output()
+            except:
+                # The shell is in an unknown state, e.g. the read was
+                # interrupted by a timeout, so it cannot be reused.
+                self.close()
+                raise
+        total_output = "{} shell cmd '{}' stdout: {}, ret: {}".format(
+            self.serial, command, out, ret)
+        if self.log:
+            self.log.debug(total_output)
+        if ret == 0:
+            return out
+        raise AdbError(total_output, ret_code=ret)
+
+    def _read_output(self):
+        lines = []
+        while True:
+            line = self._proc.stdout.readline()
+            if not line:
+                raise AdbError("adb shell process for {} exited.".format(
+                    self.serial))
+            m = SHELL_EOF_RE.match(line)
+            if m:
+                # Drop the newline echoed before the marker.
+                return b"".join(lines)[:-1], int(m.group(1))
+            lines.append(line)
+
+    def close(self):
+        """Stops the adb shell process if there is one.
+        """
+        if self._proc is None:
+            return
+        proc = self._proc
+        self._proc = None
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        try:
+            proc.stdin.close()
+        except OSError:
+            # Unflushed input cannot be written to the dead process.
+            pass
+        proc.stdout.close()
+
 class AdbProxy():
     """Proxy class for ADB.
 
@@ -94,16 +333,23 @@ class AdbProxy():
     >> adb = AdbProxy(<serial>)
     >> adb.start_server()
     >> adb.devices() # will return the console output of "adb devices".
+
+    If persistent_shell is True, shell commands are run through a
+    PersistentAdbShell when possible instead of spawning an adb process per
+    command.
     """
-    def __init__(self, serial="", log=None):
+    def __init__(self, serial="", log=None, persistent_shell=False):
         self.serial = serial
         if serial:
             self.adb_str = "adb -s {}".format(serial)
         else:
             self.adb_str = "adb"
         self.log = log
+        self._persistent_shell = None
+        if persistent_shell:
+            self._persistent_shell = PersistentAdbShell(serial, log)
 
-    def _exec_cmd(self, cmd):
+    def _exec_cmd(self, cmd, timeout=None):
         """Executes adb commands in a new shell.
 
         This is specific to executing adb binary because stderr is not a good
@@ -111,15 +357,28 @@ class AdbProxy():
 
         Args:
             cmds: A string that is the adb command to execute.
+            timeout: Number of seconds to wait for the command, or None to
+                wait as long as it takes.
 
         Returns:
             The output of the adb command run if exit code is 0.
 
         Raises:
             AdbError is raised if the adb command exit code is not 0.
+            subprocess.TimeoutExpired is raised if the command did not finish
+            within the timeout. The command is killed in this case.
         """
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
-        (out, err) = proc.communicate()
+        # Run the command in its own process group, so the adb client the
+        # shell starts can be killed along with the shell.
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True,
+                                start_new_session=True)
+        try:
+            (out, err) = proc.communicate(timeout=timeout)
+        except:
+            # Don't leave the adb client running when the wait is cut short,
+            # by the timeout or e.g. by the signal of utils.timeout.
+            _kill_process_group(proc)
+            raise
         ret = proc.returncode
         total_output = "{} cmd '{}' stdout: {}, stderr: {}, ret: {}".format(
               self.serial, cmd, out, err, ret)
@@ -129,10 +388,70 @@ class AdbProxy():
         if ret == 0:
             return out
         else:
-            raise AdbError(total_output)
+            raise AdbError(total_output, ret_code=ret)
+
+    def _exec_adb_cmd(self, name, arg_str, timeout=None):
+        return self._exec_cmd(' '.join((self.adb_str, name, arg_str)),
+                              timeout=timeout)
+
+    def shell(self, *args, one_shot=False, timeout=None):
+        """Runs a shell command on the android device.
 
-    def _exec_adb_cmd(self, name, arg_str):
-        return self._exec_cmd(' '.join((self.adb_str, name, arg_str)))
+        Commands that contain characters with special meaning to a shell, e.g.
+        pipes, are always run with a one-shot "adb shell", so they behave the
+        same whether or not this proxy has a persistent shell.
+
+        The persistent shell runs one command at a time, so long running
+        commands should pass one_shot=True to not hold up other commands.
+
+        Args:
+            args: The command and its arguments.
+            one_shot: If True, the command is run with a one-shot "adb shell"
+                even if this proxy has a persistent shell.
+            timeout: Number of seconds to wait for the command before killing
+                it, or None to wait as long as it takes. A command with a
+                timeout is always run with a one-shot "adb shell".
+
+        Returns:
+            The output of the command if its exit code is 0.
+
+        Raises:
+            AdbError is raised if the command exit code is not 0.
+            subprocess.TimeoutExpired is raised if the command did not finish
+            within the timeout.
+        """
+        command = ' '.join(str(elem) for elem in args)
+        if (not one_shot and timeout is None and self._persistent_shell and
+                not SHELL_SPECIAL_CHARS.intersection(command) and
+                self._persistent_shell.is_supported):
+            try:
+                return self._persistent_shell.run(command)
+            except OSError:
+                # Could not use the persistent shell; fall back to one-shot.
+                pass
+        return self._exec_adb_cmd("shell", command, timeout=timeout)
+
+    def getprop(self, prop_name):
+        """Gets the value of a system property on the android device.
+
+        Only the requested property is read, with "getprop <prop_name>", so
+        this can run in the persistent shell of the proxy.
+
+        Args:
+            prop_name: A string that is the name of the property.
+
+        Returns:
+            A string that is the value of the property, empty if it's not set.
+        """
+        return self.shell("getprop %s" % prop_name).decode("utf-8").strip()
+
+    def close(self):
+        """Stops the persistent shell of this proxy, if there is one.
+
+        The persistent shell is started again the next time it is needed.
+        """
+        if self._persistent_shell:
+            self._persistent_shell.close()
 
     def tcp_forward(self, host_port, device_port):
         """Starts tcp forwarding.
@@ -14,10 +14,13 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from builtins import str
-from builtins import open
-
+import collections
+import concurrent.futures
 import os
+import re
+import shlex
+import subprocess
+import threading
 import time
 import traceback
 
@@ -37,6 +40,45 @@ ANDROID_DEVICE_PICK_ALL_TOKEN = "*"
 ANDROID_DEVICE_ADB_LOGCAT_PARAM_KEY = "adb_logcat_param"
 ANDROID_DEVICE_EMPTY_CONFIG_MSG = "Configuration is empty, abort!"
 ANDROID_DEVICE_NOT_LIST_CONFIG_MSG = "Configuration should be a list, abort!"
+# Matches the logline format timestamp at the beginning of an adb logcat line.
+ADB_LOGCAT_TIMESTAMP_RE = re.compile(
+    br"\d\d-\d\d \d\d:\d\d:\d\d\.\d\d\d")
+# Matches the timestamp of every line in a chunk of adb logcat output.
+ADB_LOGCAT_LINE_TIMESTAMP_RE = re.compile(
+    br"^" + ADB_LOGCAT_TIMESTAMP_RE.pattern, re.MULTILINE)
+# Matches every complete line with a timestamp in a chunk of adb logcat
+# output, including its newline.
+ADB_LOGCAT_TIMESTAMPED_LINE_RE = re.compile(
+    br"^" + ADB_LOGCAT_TIMESTAMP_RE.pattern + br".*\n", re.MULTILINE)
+# Buffer size used when reading adb logcat files.
+ADB_LOGCAT_READ_BUFFER_SIZE = 1 << 20
+# Number of bytes read from each end of an adb logcat file to find the time
+# range it covers.
+ADB_LOGCAT_PEEK_SIZE = 1 << 16
+# Shell command that returns once the Android framework finished booting.
+# Quoted so the whole loop runs on the device.
+BOOT_COMPLETION_WAIT_CMD = (
+    "'while [ \"$(getprop sys.boot_completed)\" != 1 ]; do sleep 1; done'")
+# Number of seconds to let BOOT_COMPLETION_WAIT_CMD run before falling back to
+# polling from the host.
+BOOT_COMPLETION_WAIT_TIMEOUT = 10 * 60
+# Bounds of the interval in seconds between polls for boot completion.
+BOOT_COMPLETION_MIN_POLL_INTERVAL = 0.25
+BOOT_COMPLETION_MAX_POLL_INTERVAL = 5
+# Number of seconds a device list obtained from adb or fastboot stays valid.
+DEVICE_LIST_CACHE_TTL = 2
+
+# Cached device lists, keyed by the tool that generated them. Each value is a
+# tuple of (epoch time the list was obtained, list of serials).
+_device_list_cache = {}
+
+# Devices of the testbeds that are set up and not torn down yet. Testbeds run
+# in parallel by act.py are threads of one process and share one adb server,
+# so one testbed must not remove the port forwarding of another.
+_active_ads = set()
+# Guards _active_ads. Also held by teardown_all_forwards from the check of the
+# forwarded ports until they are removed.
+_active_ads_lock = threading.Lock()
 
 class AndroidDeviceError(signals.ControllerError):
     pass
@@ -58,13 +100,21 @@ def create(configs, logger):
     else:
         # Configs is a list of dicts.
         ads = get_instances_with_configs(configs, logger)
-    connected_ads = list_adb_devices()
-
-    for ad in ads:
-        if ad.serial not in connected_ads:
-            raise DoesNotExistError(("Android device %s is specified in config"
-                                     " but is not attached.") % ad.serial)
-    _start_services_on_ads(ads)
+    connected_ads = set(list_adb_devices())
+    missing_serials = [ad.serial for ad in ads
+                       if ad.serial not in connected_ads]
+    if missing_serials:
+        raise DoesNotExistError(("Android device(s) %s specified in config but"
+                                 " not attached.") %
+                                ", ".join(str(s) for s in missing_serials))
+    # Mark the devices active before they get any port forwarding.
+    mark_devices_active(ads)
+    try:
+        _root_adb_on_ads(ads)
+        _start_services_on_ads(ads)
+    except:
+        mark_devices_inactive(ads)
+        raise
     return ads
 
 
@@ -76,9 +126,128 @@ def destroy(ads):
     """
     for ad in ads:
         try:
-            ad.clean_up()
+            ad.clean_up(remove_forward=False)
         except:
             ad.log.exception("Failed to clean up properly.")
+    mark_devices_inactive(ads)
+    teardown_all_forwards(ads)
+
+
+def mark_devices_active(ads):
+    """Marks devices as part of a testbed that is set up, so other testbeds
+    leave their adb port forwarding alone.
+
+    Args:
+        ads: A list of AndroidDevice objects.
+    """
+    with _active_ads_lock:
+        _active_ads.update(ads)
+
+
+def mark_devices_inactive(ads):
+    """Marks devices as no longer part of a testbed that is set up.
+
+    Args:
+        ads: A list of AndroidDevice objects.
+    """
+    with _active_ads_lock:
+        _active_ads.difference_update(ads)
+
+
+def teardown_all_forwards(ads):
+    """Removes the adb port forwarding of multiple AndroidDevice objects.
+
+    If no other devices are active, see mark_devices_active, and the given
+    devices own every port currently forwarded by the adb server, all of them
+    are removed with a single "adb forward --remove-all". Otherwise each
+    device's forwarding is removed separately, so ports used by others are
+    left alone.
+
+    The check of the forwarded ports and their removal is done under a lock
+    that marking devices active also takes, so a testbed in this process
+    cannot set up a forward in between. Other processes using the same adb
+    server cannot be seen; do not run them while tearing down here.
+
+    Args:
+        ads: A list of AndroidDevice objects whose port forwarding to remove.
+    """
+    ads = [ad for ad in ads if ad.h_port]
+    if not ads:
+        return
+    h_ports = set(ad.h_port for ad in ads)
+    with _active_ads_lock:
+        try:
+            if (_active_ads.issubset(ads) and
+                    set(adb.list_occupied_adb_ports()) <= h_ports):
+                adb.AdbProxy().forward("--remove-all")
+                for ad in ads:
+                    ad.h_port = None
+                    ad._forward_established = False
+                return
+        except adb.AdbError:
+            # Fall back to removing the forwarding of each device.
+            pass
+    for ad in ads:
+        try:
+            ad.adb.forward("--remove tcp:%d" % ad.h_port)
+            ad.h_port = None
+            ad._forward_established = False
+        except:
+            ad.log.exception("Failed to remove adb port forwarding.")
+
+
+def _get_logcat_time_range(f, size):
+    """Gets the timestamps of the first and last lines of an adb logcat
+    file, by only reading a chunk from each end of the file.
+
+    Args:
+        f: The logcat file, opened in binary mode.
+        size: The number of bytes of the file to consider.
+
+    Returns:
+        A tuple of the first and last logline timestamps as byte strings, or
+        None if either could not be found.
+    """
+    f.seek(0)
+    first = ADB_LOGCAT_LINE_TIMESTAMP_RE.search(f.read(ADB_LOGCAT_PEEK_SIZE))
+    tail_start = max(size - ADB_LOGCAT_PEEK_SIZE, 0)
+    f.seek(tail_start)
+    tail = f.read(size - tail_start)
+    if tail_start:
+        # Drop the partial line the chunk starts in.
+        tail = tail.partition(b"\n")[2]
+    last = ADB_LOGCAT_LINE_TIMESTAMP_RE.findall(tail)
+    if not first or not last:
+        return None
+    return first.group(), last[-1]
+
+
+def _copy_timestamped_lines(src, dst, size):
+    """Copies the lines of an adb logcat file that start with a logline
+    timestamp into another file, a chunk at a time.
+
+    The lines are picked out of each chunk with a single regex search instead
+    of a loop over the lines. The last line gets a newline if it has none.
+
+    Args:
+        src: The logcat file to copy from, opened in binary mode.
+        dst: The file to copy to, opened in binary mode.
+        size: The number of bytes of src to consider.
+    """
+    src.seek(0)
+    remaining = size
+    partial_line = b""
+    while remaining:
+        chunk = src.read(min(ADB_LOGCAT_READ_BUFFER_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        chunk = partial_line + chunk
+        end = chunk.rfind(b"\n") + 1
+        lines, partial_line = chunk[:end], chunk[end:]
+        dst.write(b"".join(ADB_LOGCAT_TIMESTAMPED_LINE_RE.findall(lines)))
+    if ADB_LOGCAT_TIMESTAMP_RE.match(partial_line):
+        dst.write(partial_line + b"\n")
 
 
 def get_info(ads):
@@ -98,24 +267,43 @@ def get_info(ads):
     return device_info
 
 
+def _root_adb_on_ads(ads):
+    """Changes adb to root mode on multiple AndroidDevice objects concurrently.
+
+    Devices in bootloader mode are skipped.
+
+    Args:
+        ads: A list of AndroidDevice objects to change adb mode on.
+    """
+    def _root_adb(ad):
+        if not ad.is_bootloader:
+            ad.root_adb()
+    results = utils.concurrent_exec(_root_adb, [(ad,) for ad in ads])
+    for r in results:
+        if isinstance(r, Exception):
+            raise r
+
 def _start_services_on_ads(ads):
     """Starts long running services on multiple AndroidDevice objects.
 
-    If any one AndroidDevice object fails to start services, cleans up all
-    existing AndroidDevice objects and their services.
+    Services are started on all the devices concurrently. If any one
+    AndroidDevice object fails to start services, cleans up all existing
+    AndroidDevice objects and their services.
 
     Args:
         ads: A list of AndroidDevice objects whose services to start.
     """
-    running_ads = []
-    for ad in ads:
-        running_ads.append(ad)
+    def _start_services(ad):
         try:
             ad.start_services(skip_sl4a=getattr(ad, "skip_sl4a", False))
         except:
             ad.log.exception("Failed to start some services, abort!")
-            destroy(running_ads)
             raise
+    results = utils.concurrent_exec(_start_services, [(ad,) for ad in ads])
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        destroy(ads)
+        raise errors[0]
 
 def _parse_device_list(device_list_str, key):
     """Parses a byte string representing a list of devices. The string is
@@ -128,33 +316,68 @@ def _parse_device_list(device_list_str, key):
     Returns:
         A list of android device serial numbers.
     """
-    clean_lines = str(device_list_str, 'utf-8').strip().split('\n')
-    results = []
-    for line in clean_lines:
-        tokens = line.strip().split('\t')
-        if len(tokens) == 2 and tokens[1] == key:
-            results.append(tokens[0])
-    return results
+    pattern = (br"^[ \t]*(\S+)\t" + re.escape(key.encode("utf-8")) +
+               br"[ \t\r]*$")
+    return [serial.decode("utf-8") for serial in
+            re.findall(pattern, device_list_str, re.MULTILINE)]
+
+def _get_cached_device_list(tool, list_func):
+    """Gets a device list from the cache, or from list_func if the cached list
+    is missing or older than DEVICE_LIST_CACHE_TTL.
+
+    Args:
+        tool: A string that is the name of the tool generating the list, used
+            as the cache key.
+        list_func: A function that takes no argument and returns a list of
+            device serials.
+
+    Returns:
+        A list of android device serials.
+    """
+    now = time.time()
+    cached = _device_list_cache.get(tool)
+    if cached and now - cached[0] < DEVICE_LIST_CACHE_TTL:
+        return list(cached[1])
+    serials = list_func()
+    _device_list_cache[tool] = (now, serials)
+    return list(serials)
+
+def invalidate_device_cache():
+    """Drops the cached device lists, so the next call to list_adb_devices or
+    list_fastboot_devices queries adb or fastboot again.
+
+    Call this after doing something that changes the state of a device, e.g.
+    rebooting it.
+    """
+    _device_list_cache.clear()
 
 def list_adb_devices():
     """List all android devices connected to the computer that are detected by
     adb.
 
+    The result may be up to DEVICE_LIST_CACHE_TTL seconds old.
+
     Returns:
         A list of android device serials. Empty if there's none.
     """
-    out = adb.AdbProxy().devices()
-    return _parse_device_list(out, "device")
+    def _list():
+        out = adb.AdbProxy().devices()
+        return _parse_device_list(out, "device")
+    return _get_cached_device_list("adb", _list)
 
 def list_fastboot_devices():
     """List all android devices connected to the computer that are in in
     fastboot mode. These are detected by fastboot.
 
+    The result may be up to DEVICE_LIST_CACHE_TTL seconds old.
+
     Returns:
         A list of android device serials. Empty if there's none.
     """
-    out = fastboot.FastbootProxy().devices()
-    return _parse_device_list(out, "fastboot")
+    def _list():
+        out = fastboot.FastbootProxy().devices()
+        return _parse_device_list(out, "fastboot")
+    return _get_cached_device_list("fastboot", _list)
 
 def get_instances(serials, logger=None):
     """Create AndroidDevice instances from a list of serials.
@@ -318,22 +541,39 @@ class AndroidDevice:
         self.log = acts_logger.LoggerProxy(logger)
         lp = self.log.log_path
         self.log_path = os.path.join(lp, "AndroidDevice%s" % serial)
-        self._droid_sessions = {}
-        self._event_dispatchers = {}
+        self._model = None
+        self._has_bugreportz = None
+        self._adb_root_state = None
+        # Whether h_port is currently forwarded to d_port on the device.
+        self._forward_established = False
+        # Ordered by creation so the first session is found without sorting.
+        self._droid_sessions = collections.OrderedDict()
+        self._event_dispatchers = collections.OrderedDict()
         self.adb_logcat_process = None
         self.adb_logcat_file_path = None
-        self.adb = adb.AdbProxy(serial)
+        self.adb = adb.AdbProxy(serial, persistent_shell=True)
         self.fastboot = fastboot.FastbootProxy(serial)
-        if not self.is_bootloader:
-            self.root_adb()
 
-    def clean_up(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.clean_up()
+
+    def clean_up(self, remove_forward=True):
         """Cleans up the AndroidDevice object and releases any resources it
         claimed.
+
+        Args:
+            remove_forward: If False, the adb port forwarding is kept so it
+                can be removed later, e.g. by teardown_all_forwards.
         """
-        self.stop_services()
-        if self.h_port:
+        self.stop_services(remove_forward=remove_forward)
+        if remove_forward and self.h_port:
             self.adb.forward("--remove tcp:%d" % self.h_port)
+            self.h_port = None
+            self._forward_established = False
+        self.adb.close()
 
     # TODO(angli): This function shall be refactored to accommodate all services
     # and not have hard coded switch for SL4A when b/29157104 is done.
@@ -359,14 +599,18 @@ class AndroidDevice:
                 self.log.exception("Failed to start sl4a!")
                 raise
 
-    def stop_services(self):
+    def stop_services(self, remove_forward=True):
         """Stops long running services on the android device.
 
         Stop adb logcat and terminate sl4a sessions if exist.
+
+        Args:
+            remove_forward: Whether to remove the adb port forwarding once the
+                sl4a sessions are terminated.
         """
         if self.adb_logcat_process:
             self.stop_adb_logcat()
-        self.terminate_all_sessions()
+        self.terminate_all_sessions(remove_forward=remove_forward)
 
     @property
     def build_info(self):
@@ -382,10 +626,8 @@ class AndroidDevice:
         if self.is_bootloader:
             return
         info = {}
-        info["build_id"] = self.adb.shell("getprop ro.build.id").decode(
-            "utf-8").strip()
-        info["build_type"] = self.adb.shell("getprop ro.build.type").decode(
-            "utf-8").strip()
+        info["build_id"] = self.adb.getprop("ro.build.id")
+        info["build_type"] = self.adb.getprop("ro.build.type")
         return info
 
     @property
@@ -397,17 +639,45 @@ class AndroidDevice:
     @property
     def is_adb_root(self):
         """True if adb is running as root for this device.
+
+        The result is cached until adb is restarted by root_adb or reboot.
         """
-        try:
-            return "0" == self.adb.shell("id -u").decode("utf-8").strip()
-        except adb.AdbError:
-            # Wait a bit and retry to work around adb flakiness for this cmd.
-            time.sleep(0.2)
-            return "0" == self.adb.shell("id -u").decode("utf-8").strip()
+        if self._adb_root_state is None:
+            try:
+                out = self.adb.shell("id -u")
+            except adb.AdbError:
+                # Wait a bit and retry to work around adb flakiness for this
+                # cmd.
+                time.sleep(0.2)
+                out = self.adb.shell("id -u")
+            self._adb_root_state = "0" == out.decode("utf-8").strip()
+        return self._adb_root_state
+
+    @property
+    def has_bugreportz(self):
+        """True if the device supports taking zipped bug reports with
+        bugreportz.
+
+        The result is cached until the device reboots, once the probe gives a
+        definite answer. If it fails for another reason than bugreportz not
+        being found, e.g. adb flakiness, False is returned and the device is
+        probed again next time.
+        """
+        if self._has_bugreportz is None:
+            try:
+                self.adb.shell("bugreportz -v")
+                self._has_bugreportz = True
+            except adb.AdbError as e:
+                if e.ret_code != adb.SHELL_COMMAND_NOT_FOUND:
+                    return False
+                self._has_bugreportz = False
+        return self._has_bugreportz
 
     @property
     def model(self):
         """The Android code name for the device.
+
+        The code name obtained through adb is cached until the device reboots.
         """
         # If device is in bootloader mode, get mode name from fastboot.
         if self.is_bootloader:
@@ -420,36 +690,30 @@ class AndroidDevice:
                 if len(tokens) > 1:
                     return tokens[1].lower()
             return None
-        out = self.adb.shell('getprop | grep ro.build.product')
-        model = out.decode("utf-8").strip().split('[')[-1][:-1].lower()
-        if model == "sprout":
-            return model
-        else:
-            out = self.adb.shell('getprop | grep ro.product.name')
-            model = out.decode("utf-8").strip().split('[')[-1][:-1].lower()
-            return model
+        if self._model is None:
+            model = self.adb.getprop("ro.build.product").lower()
+            if model != "sprout":
+                model = self.adb.getprop("ro.product.name").lower()
+            self._model = model
+        return self._model
 
     @property
     def droid(self):
         """The first sl4a session initiated on this device. None if there isn't
         one.
         """
-        try:
-            session_id = sorted(self._droid_sessions)[0]
-            return self._droid_sessions[session_id][0]
-        except IndexError:
-            return None
+        for session in self._droid_sessions.values():
+            return session[0]
+        return None
 
     @property
     def ed(self):
         """The first event_dispatcher instance created on this device. None if
         there isn't one.
         """
-        try:
-            session_id = sorted(self._event_dispatchers)[0]
-            return self._event_dispatchers[session_id]
-        except IndexError:
-            return None
+        for ed in self._event_dispatchers.values():
+            return ed
+        return None
 
     @property
     def droids(self):
@@ -458,11 +722,7 @@ class AndroidDevice:
         If multiple connections exist for the same session, only one connection
         is listed.
         """
-        keys = sorted(self._droid_sessions)
-        results = []
-        for k in keys:
-            results.append(self._droid_sessions[k][0])
-        return results
+        return [session[0] for session in self._droid_sessions.values()]
 
     @property
     def eds(self):
@@ -470,11 +730,7 @@ class AndroidDevice:
 
         The indexing of the list matches that of the droids property.
         """
-        keys = sorted(self._event_dispatchers)
-        results = []
-        for k in keys:
-            results.append(self._event_dispatchers[k])
-        return results
+        return list(self._event_dispatchers.values())
 
     @property
     def is_adb_logcat_on(self):
@@ -505,9 +761,19 @@ class AndroidDevice:
 
         If executed on a production build, adb will not be switched to root
         mode per security restrictions.
+
+        Nothing is done if adb is already running as root.
         """
+        if self.is_adb_root:
+            return
         self.adb.root()
+        self._adb_root_state = None
+        # Port forwarding goes away with the adbd connection.
+        self._forward_established = False
+        # adbd restarts as root, which ends the existing shell connection.
+        self.adb.close()
         self.adb.wait_for_device()
+        invalidate_device_cache()
 
     def get_droid(self, handle_event=True):
         """Create an sl4a connection to the device.
@@ -535,9 +801,11 @@ class AndroidDevice:
             >>> ad = AndroidDevice()
             >>> droid, ed = ad.get_droid()
         """
-        if not self.h_port or not adb.is_port_available(self.h_port):
-            self.h_port = adb.get_available_host_port()
-        self.adb.tcp_forward(self.h_port, self.d_port)
+        if not self._forward_established:
+            if not self.h_port or not adb.is_port_available(self.h_port):
+                self.h_port = adb.get_available_host_port()
+            self.adb.tcp_forward(self.h_port, self.d_port)
+            self._forward_established = True
         try:
             droid = self.start_new_session()
         except:
@@ -557,23 +825,18 @@ class AndroidDevice:
         Returns:
             ed: An EventDispatcher for specified session.
         """
-        ed_key = self.serial + str(droid.uid)
-        if ed_key in self._event_dispatchers:
-            if self._event_dispatchers[ed_key] is None:
+        # Event dispatchers are keyed by the uid of the session they belong to.
+        if droid.uid in self._event_dispatchers:
+            if self._event_dispatchers[droid.uid] is None:
                 raise AndroidDeviceError("EventDispatcher Key Empty")
-            self.log.debug("Returning existing key %s for event dispatcher!",
-                           ed_key)
-            return self._event_dispatchers[ed_key]
+            self.log.debug("Returning existing event dispatcher for session "
+                           "%s!", droid.uid)
+            return self._event_dispatchers[droid.uid]
         event_droid = self.add_new_connection_to_session(droid.uid)
         ed = event_dispatcher.EventDispatcher(event_droid)
-        self._event_dispatchers[ed_key] = ed
+        self._event_dispatchers[droid.uid] = ed
         return ed
 
-    def _is_timestamp_in_range(self, target, begin_time, end_time):
-        low = acts_logger.logline_timestamp_comparator(begin_time, target) <= 0
-        high = acts_logger.logline_timestamp_comparator(end_time, target) >= 0
-        return low and high
-
     def cat_adb_log(self, tag, begin_time):
         """Takes an excerpt of the adb logcat log from a certain time point to
         current time.
@@ -598,30 +861,38 @@ class AndroidDevice:
         tag = tag[:tag_len]
         out_name = tag + out_name
         full_adblog_path = os.path.join(adb_excerpt_path, out_name)
-        with open(full_adblog_path, 'w', encoding='utf-8') as out:
+        # Logline timestamps are fixed width with zero padded fields, so
+        # comparing them as byte strings orders them chronologically.
+        begin = begin_time.encode("utf-8")
+        end = end_time.encode("utf-8")
+        with open(full_adblog_path, 'wb') as out:
             in_file = self.adb_logcat_file_path
-            with open(in_file, 'r', encoding='utf-8', errors='replace') as f:
+            with open(in_file, 'rb',
+                      buffering=ADB_LOGCAT_READ_BUFFER_SIZE) as f:
+                # Logcat keeps appending to the file, so only look at what
+                # is there now.
+                size = os.fstat(f.fileno()).st_size
+                time_range = _get_logcat_time_range(f, size)
+                if (time_range and begin <= time_range[0] and
+                        time_range[1] <= end):
+                    # The whole log is in the time period. Like the filter
+                    # below, keep only the lines with a timestamp, but without
+                    # looking at each line in Python.
+                    _copy_timestamped_lines(f, out, size)
+                    return
+                f.seek(0)
                 in_range = False
-                while True:
-                    line = None
-                    try:
-                        line = f.readline()
-                        if not line:
-                            break
-                    except:
-                        continue
-                    line_time = line[:acts_logger.log_line_timestamp_len]
-                    if not acts_logger.is_valid_logline_timestamp(line_time):
+                for line in f:
+                    m = ADB_LOGCAT_TIMESTAMP_RE.match(line)
+                    if not m:
                         continue
-                    if self._is_timestamp_in_range(line_time, begin_time,
-                        end_time):
+                    if begin <= m.group() <= end:
                         in_range = True
-                        if not line.endswith('\n'):
-                            line += '\n'
+                        if not line.endswith(b'\n'):
+                            line += b'\n'
                         out.write(line)
-                    else:
-                        if in_range:
-                            break
+                    elif in_range:
+                        break
 
     def start_adb_logcat(self):
         """Starts a standing adb logcat collection in separate subprocesses and
@@ -640,9 +911,10 @@ class AndroidDevice:
             extra_params = self.adb_logcat_param
         except AttributeError:
             extra_params = ""
-        cmd = "adb -s {} logcat -v threadtime {} >> {}".format(
-            self.serial, extra_params, logcat_file_path)
-        self.adb_logcat_process = utils.start_standing_subprocess(cmd)
+        cmd = ["adb", "-s", str(self.serial), "logcat", "-v", "threadtime"]
+        cmd.extend(shlex.split(extra_params))
+        self.adb_logcat_process = utils.start_standing_subprocess(
+            cmd, stdout_file=logcat_file_path)
         self.adb_logcat_file_path = logcat_file_path
 
     def stop_adb_logcat(self):
@@ -662,11 +934,9 @@ class AndroidDevice:
             test_name: Name of the test case that triggered this bug report.
             begin_time: Logline format timestamp taken when the test started.
         """
-        new_br = True
-        try:
-            self.adb.shell("bugreportz -v")
-        except adb.AdbError:
-            new_br = False
+        # in case device restarted, wait for adb interface to return
+        self.wait_for_boot_completion()
+        new_br = self.has_bugreportz
         br_path = os.path.join(self.log_path, "BugReports")
         utils.create_dir(br_path)
         base_name = ",{},{}.txt".format(begin_time, self.serial)
@@ -675,15 +945,13 @@ class AndroidDevice:
         test_name_len = utils.MAX_FILENAME_LEN - len(base_name)
         out_name = test_name[:test_name_len] + base_name
         full_out_path = os.path.join(br_path, out_name.replace(' ', '\ '))
-        # in case device restarted, wait for adb interface to return
-        self.wait_for_boot_completion()
         self.log.info("Taking bugreport for %s.", test_name)
         if new_br:
-            out = self.adb.shell("bugreportz").decode("utf-8")
+            out = self.adb.shell("bugreportz", one_shot=True).decode("utf-8")
             if not out.startswith("OK"):
                 raise AndroidDeviceError("Failed to take bugreport on %s" %
                                          self.serial)
-            br_out_path = out.split(':')[1].strip()
+            br_out_path = out.partition(':')[2].strip()
             self.adb.pull("%s %s" % (br_out_path, full_out_path))
         else:
             self.adb.bugreport(" > {}".format(full_out_path))
@@ -744,15 +1012,18 @@ class AndroidDevice:
                 droid.closeSl4aSession()
                 droid.close()
             del self._droid_sessions[session_id]
-        ed_key = self.serial + str(session_id)
-        if ed_key in self._event_dispatchers:
-            self._event_dispatchers[ed_key].clean_up()
-            del self._event_dispatchers[ed_key]
+        if session_id in self._event_dispatchers:
+            self._event_dispatchers[session_id].clean_up()
+            del self._event_dispatchers[session_id]
 
-    def terminate_all_sessions(self):
+    def terminate_all_sessions(self, remove_forward=True):
         """Terminate all sl4a sessions on the AndroidDevice instance.
 
         Terminate all sessions and clear caches.
+
+        Args:
+            remove_forward: Whether to remove the adb port forwarding once the
+                sessions are terminated.
         """
         if self._droid_sessions:
             session_ids = list(self._droid_sessions.keys())
@@ -763,9 +1034,10 @@ class AndroidDevice:
                     msg = "Failed to terminate session %d." % session_id
                     self.log.exception(msg)
                     self.log.error(traceback.format_exc())
-            if self.h_port:
+            if remove_forward and self.h_port:
                 self.adb.forward("--remove tcp:%d" % self.h_port)
                 self.h_port = None
+                self._forward_established = False
 
     def run_iperf_client(self, server_host, extra_args=""):
         """Start iperf client on the device.
@@ -782,7 +1054,8 @@ class AndroidDevice:
             status: true if iperf client start successfully.
             results: results have data flow information
         """
-        out = self.adb.shell("iperf3 -c {} {}".format(server_host, extra_args))
+        out = self.adb.shell("iperf3 -c {} {}".format(server_host, extra_args),
+                             one_shot=True)
         clean_out = str(out,'utf-8').strip().split('\n')
         if "error" in clean_out[0].lower():
             return False, clean_out
@@ -793,20 +1066,30 @@ class AndroidDevice:
         """Waits for the Android framework to boot back up and ready to launch
         apps.
 
+        The wait is done in a loop on the device first, which avoids an adb
+        round trip per poll. If that is cut short, e.g. adbd restarted, or
+        times out, the property is polled from here with an exponentially
+        growing interval.
+
         This function times out after 15 minutes.
         """
         self.adb.wait_for_device()
+        try:
+            self.adb.shell(BOOT_COMPLETION_WAIT_CMD,
+                           timeout=BOOT_COMPLETION_WAIT_TIMEOUT)
+        except (adb.AdbError, subprocess.TimeoutExpired):
+            pass
+        interval = BOOT_COMPLETION_MIN_POLL_INTERVAL
         while True:
             try:
-                out = self.adb.shell("getprop sys.boot_completed")
-                completed = out.decode('utf-8').strip()
-                if completed == '1':
+                if self.adb.getprop("sys.boot_completed") == '1':
                     return
             except adb.AdbError:
                 # adb shell calls may fail during certain period of booting
                 # process, which is normal. Ignoring these errors.
                 pass
-            time.sleep(5)
+            time.sleep(interval)
+            interval = min(interval * 2, BOOT_COMPLETION_MAX_POLL_INTERVAL)
 
     def reboot(self):
         """Reboots the device.
@@ -829,6 +1112,11 @@ class AndroidDevice:
             AndroidDeviceError is raised if waiting for completion timed
             out.
         """
+        invalidate_device_cache()
+        self._model = None
+        self._has_bugreportz = None
+        self._adb_root_state = None
+        self._forward_established = False
         if self.is_bootloader:
             self.fastboot.reboot()
             return
@@ -837,10 +1125,18 @@ class AndroidDevice:
             self.stop_adb_logcat()
         self.terminate_all_sessions()
         self.adb.reboot()
+        self.adb.close()
         self.wait_for_boot_completion()
+        invalidate_device_cache()
+        # Switching adb to root restarts adbd, so it has to be done before
+        # anything else is started on the device.
         self.root_adb()
-        droid, ed = self.get_droid()
-        ed.start()
-        if has_adb_log:
-            self.start_adb_logcat()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            # Start adb logcat while sl4a is being launched.
+            if has_adb_log:
+                logcat_future = executor.submit(self.start_adb_logcat)
+            droid, ed = self.get_droid()
+            ed.start()
+            if has_adb_log:
+                logcat_future.result()
         return droid, ed
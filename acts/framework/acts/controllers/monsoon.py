@@ -18,14 +18,15 @@
 (http://msoon.com/LabEquipment/PowerMonitor/).
 """
 
+import array
 import fcntl
+import math
 import os
 import select
 import struct
 import sys
 import time
 import traceback
-import collections
 
 # http://pyserial.sourceforge.net/
 # On ubuntu, apt-get install python3-pyserial
@@ -40,6 +41,9 @@ from acts.controllers import android_device
 ACTS_CONTROLLER_CONFIG_NAME = "Monsoon"
 ACTS_CONTROLLER_REFERENCE_NAME = "monsoons"
 
+# Number of seconds between checks for an android device to reappear in adb.
+DEVICE_POLL_INTERVAL = 0.5
+
 def create(configs, logger):
     objs = []
     for c in configs:
@@ -49,6 +53,60 @@ def create(configs, logger):
 def destroy(objs):
     return
 
+# status packet format
+STATUS_STRUCT = struct.Struct(">BBBhhhHhhhHBBBxBbHBHHHHBbbHHBBBbbbbbbbbbBH")
+STATUS_FIELDS = [
+        "packetType", "firmwareVersion", "protocolVersion",
+        "mainFineCurrent", "usbFineCurrent", "auxFineCurrent",
+        "voltage1", "mainCoarseCurrent", "usbCoarseCurrent",
+        "auxCoarseCurrent", "voltage2", "outputVoltageSetting",
+        "temperature", "status", "leds", "mainFineResistor",
+        "serialNumber", "sampleRate", "dacCalLow", "dacCalHigh",
+        "powerUpCurrentLimit", "runTimeCurrentLimit", "powerUpTime",
+        "usbFineResistor", "auxFineResistor",
+        "initialUsbVoltage", "initialAuxVoltage",
+        "hardwareRevision", "temperatureLimit", "usbPassthroughMode",
+        "mainCoarseResistor", "usbCoarseResistor", "auxCoarseResistor",
+        "defMainFineResistor", "defUsbFineResistor",
+        "defAuxFineResistor", "defMainCoarseResistor",
+        "defUsbCoarseResistor", "defAuxCoarseResistor", "eventCode",
+        "eventData", ]
+
+def _get_status_converter(field):
+    """Gets the function that converts the raw value of a status field to its
+    actual value.
+
+    Args:
+        field: The name of the status field.
+
+    Returns:
+        A function that takes the raw value and returns the converted value,
+        or None if the raw value is used as is.
+    """
+    if field.endswith("VoltageSetting"):
+        return lambda v: 2.0 + v * 0.01
+    elif field.endswith("FineCurrent") or field.endswith("CoarseCurrent"):
+        return None # needs calibration data
+    elif field.startswith("voltage") or field.endswith("Voltage"):
+        return lambda v: v * 0.000125
+    elif field.endswith("Resistor"):
+        if field.startswith("aux") or field.startswith("defAux"):
+            return lambda v: 0.05 + v * 0.0001 + 0.05
+        return lambda v: 0.05 + v * 0.0001
+    elif field.endswith("CurrentLimit"):
+        return lambda v: 8 * (1023 - v) / 1023.0
+    return None
+
+# Pairs of (status field, converter) for the fields whose raw value needs to
+# be converted, worked out once instead of for every status packet.
+STATUS_CONVERTERS = [(f, c) for f, c in
+                     ((f, _get_status_converter(f)) for f in STATUS_FIELDS)
+                     if c]
+
+# data packet format
+DATA_HEADER_STRUCT = struct.Struct("BBBB")
+DATA_SAMPLE_STRUCT = struct.Struct(">hhhh")
+
 class MonsoonError(acts.signals.ControllerError):
     """Raised for exceptions encountered in monsoon lib."""
 
@@ -140,55 +198,22 @@ class MonsoonProxy:
         Returns:
             status dictionary.
         """
-        # status packet format
-        STATUS_FORMAT = ">BBBhhhHhhhHBBBxBbHBHHHHBbbHHBBBbbbbbbbbbBH"
-        STATUS_FIELDS = [
-                "packetType", "firmwareVersion", "protocolVersion",
-                "mainFineCurrent", "usbFineCurrent", "auxFineCurrent",
-                "voltage1", "mainCoarseCurrent", "usbCoarseCurrent",
-                "auxCoarseCurrent", "voltage2", "outputVoltageSetting",
-                "temperature", "status", "leds", "mainFineResistor",
-                "serialNumber", "sampleRate", "dacCalLow", "dacCalHigh",
-                "powerUpCurrentLimit", "runTimeCurrentLimit", "powerUpTime",
-                "usbFineResistor", "auxFineResistor",
-                "initialUsbVoltage", "initialAuxVoltage",
-                "hardwareRevision", "temperatureLimit", "usbPassthroughMode",
-                "mainCoarseResistor", "usbCoarseResistor", "auxCoarseResistor",
-                "defMainFineResistor", "defUsbFineResistor",
-                "defAuxFineResistor", "defMainCoarseResistor",
-                "defUsbCoarseResistor", "defAuxCoarseResistor", "eventCode",
-                "eventData", ]
-
         self._SendStruct("BBB", 0x01, 0x00, 0x00)
         while 1:  # Keep reading, discarding non-status packets
             read_bytes = self._ReadPacket()
             if not read_bytes:
                 return None
-            calsize = struct.calcsize(STATUS_FORMAT)
-            if len(read_bytes) != calsize or read_bytes[0] != 0x10:
+            if (len(read_bytes) != STATUS_STRUCT.size or
+                    read_bytes[0] != 0x10):
                 print("Wanted status, dropped type=0x%02x, len=%d" % (
                     read_bytes[0], len(read_bytes)), file=sys.stderr)
                 continue
-            status = dict(zip(STATUS_FIELDS, struct.unpack(STATUS_FORMAT,
-                read_bytes)))
+            status = dict(zip(STATUS_FIELDS, STATUS_STRUCT.unpack(read_bytes)))
             p_type = status["packetType"]
             if p_type != 0x10:
                 raise MonsoonError("Package type %s is not 0x10." % p_type)
-            for k in status.keys():
-                if k.endswith("VoltageSetting"):
-                    status[k] = 2.0 + status[k] * 0.01
-                elif k.endswith("FineCurrent"):
-                    pass # needs calibration data
-                elif k.endswith("CoarseCurrent"):
-                    pass # needs calibration data
-                elif k.startswith("voltage") or k.endswith("Voltage"):
-                    status[k] = status[k] * 0.000125
-                elif k.endswith("Resistor"):
-                    status[k] = 0.05 + status[k] * 0.0001
-                    if k.startswith("aux") or k.startswith("defAux"):
-                        status[k] += 0.05
-                elif k.endswith("CurrentLimit"):
-                    status[k] = 8 * (1023 - status[k]) / 1023.0
+            for k, convert in STATUS_CONVERTERS:
+                status[k] = convert(status[k])
             return status
 
     def RampVoltage(self, start, end):
@@ -272,9 +297,11 @@ class MonsoonProxy:
                     _bytes[0], len(_bytes)), file=sys.stderr)
                 continue
 
-            seq, _type, x, y = struct.unpack("BBBB", _bytes[:4])
-            data = [struct.unpack(">hhhh", _bytes[x:x+8])
-                            for x in range(4, len(_bytes) - 8, 8)]
+            seq, _type, x, y = DATA_HEADER_STRUCT.unpack_from(_bytes)
+            # Each sample is 8 bytes, excluding the last 8 bytes of a packet.
+            data_end = 4 + DATA_SAMPLE_STRUCT.size * len(
+                range(4, len(_bytes) - 8, 8))
+            data = list(DATA_SAMPLE_STRUCT.iter_unpack(_bytes[4:data_end]))
 
             if self._last_seq and seq & 0xF != (self._last_seq + 1) & 0xF:
                 print("Data sequence skipped, lost packet?", file=sys.stderr)
@@ -285,14 +312,15 @@ class MonsoonProxy:
                     print("Waiting for calibration, dropped data packet.",
                         file=sys.stderr)
                     continue
-                out = []
-                for main, usb, aux, voltage in data:
-                    if main & 1:
-                        coarse = ((main & ~1) - self._coarse_zero)
-                        out.append(coarse * self._coarse_scale)
-                    else:
-                        out.append((main - self._fine_zero) * self._fine_scale)
-                return out
+                # Look the calibration values up once per packet, not once
+                # per sample.
+                coarse_zero = self._coarse_zero
+                coarse_scale = self._coarse_scale
+                fine_zero = self._fine_zero
+                fine_scale = self._fine_scale
+                return [((main & ~1) - coarse_zero) * coarse_scale if main & 1
+                        else (main - fine_zero) * fine_scale
+                        for main, usb, aux, voltage in data]
             elif _type == 1:
                 self._fine_zero = data[0][0]
                 self._coarse_zero = data[1][0]
@@ -373,13 +401,19 @@ class MonsoonData:
     sr = 6
     # Delimiter for writing multiple MonsoonData objects to text file.
     delimiter = "\n\n==========\n\n"
+    # A measurement can hold a lot of data points, and there can be many
+    # measurements in a test, so don't give each object a __dict__.
+    __slots__ = ("_data_points", "_timestamps", "offset",
+                 "_offset_data_points", "_offset_timestamps", "hz", "voltage",
+                 "tag", "_data_points_sum")
 
     def __init__(self, data_points, timestamps, hz, voltage, offset=0):
         """Instantiates a MonsoonData object.
 
         Args:
-            data_points: A list of current values in Amp (float).
-            timestamps: A list of epoch timestamps (int).
+            data_points: A sequence, e.g. list or array, of current values in
+                Amp (float).
+            timestamps: A sequence of epoch timestamps (int).
             hz: The hertz at which the data points are measured.
             voltage: The voltage at which the data points are measured.
             offset: The number of initial data points to discard
@@ -392,13 +426,29 @@ class MonsoonData:
         if self.offset >= num_of_data_pt:
             raise MonsoonError(("Offset number (%d) must be smaller than the "
                 "number of data points (%d).") % (offset, num_of_data_pt))
-        self.data_points = self._data_points[self.offset:]
-        self.timestamps = self._timestamps[self.offset:]
+        self._offset_data_points = tuple(self._data_points[self.offset:])
+        self._offset_timestamps = tuple(self._timestamps[self.offset:])
+        self._data_points_sum = None
         self.hz = hz
         self.voltage = voltage
         self.tag = None
         self._validate_data()
 
+    @property
+    def data_points(self):
+        """A tuple of the data points after the offset.
+
+        Read-only, so the cached sum of the data points stays valid. Use
+        update_offset to change the offset.
+        """
+        return self._offset_data_points
+
+    @property
+    def timestamps(self):
+        """A tuple of the timestamps of the data points after the offset.
+        """
+        return self._offset_timestamps
+
     @property
     def average_current(self):
         """Average current in the unit of mA.
@@ -406,14 +456,14 @@ class MonsoonData:
         len_data_pt = len(self.data_points)
         if len_data_pt == 0:
             return 0
-        cur = sum(self.data_points) * 1000 / len_data_pt
+        cur = self._get_data_points_sum() * 1000 / len_data_pt
         return round(cur, self.sr)
 
     @property
     def total_charge(self):
         """Total charged used in the unit of mAh.
         """
-        charge = (sum(self.data_points) / self.hz) * 1000 / 3600
+        charge = (self._get_data_points_sum() / self.hz) * 1000 / 3600
         return round(charge, self.sr)
 
     @property
@@ -434,31 +484,34 @@ class MonsoonData:
         Returns:
             A MonsoonData object.
         """
-        lines = data_str.strip().split('\n')
+        lines = data_str.strip().split('\n', 6)
         err_msg = ("Invalid input string format. Is this string generated by "
                    "MonsoonData class?")
-        conditions = [len(lines) <= 4,
-                      "Average Current:" not in lines[1],
-                      "Voltage: " not in lines[2],
-                      "Total Power: " not in lines[3],
-                      "samples taken at " not in lines[4],
-                      lines[5] != "Time" + ' ' * 7 + "Amp"]
-        if any(conditions):
+        if (len(lines) < 7 or
+                "Average Current:" not in lines[1] or
+                "Voltage: " not in lines[2] or
+                "Total Power: " not in lines[3] or
+                "samples taken at " not in lines[4] or
+                lines[5] != "Time" + ' ' * 7 + "Amp"):
+            raise MonsoonError(err_msg)
+        try:
+            # e.g. "5000 samples taken at 5000Hz, with an offset of 0 samples."
+            hz = int(lines[4].split()[4][:-3])
+            # e.g. "Voltage: 4.2V."
+            voltage = float(lines[2].split()[1][:-2])
+        except (IndexError, ValueError):
+            raise MonsoonError(err_msg)
+        # Each data line is "<timestamp> <value>". Split all of them at once
+        # instead of line by line, then make sure no line had extra tokens.
+        num_lines = lines[6].count('\n') + 1
+        tokens = lines[6].split()
+        if len(tokens) != 2 * num_lines:
+            raise MonsoonError(err_msg)
+        try:
+            t = list(map(int, tokens[0::2]))
+            v = list(map(float, tokens[1::2]))
+        except ValueError:
             raise MonsoonError(err_msg)
-        hz_str = lines[4].split()[2]
-        hz = int(hz_str[:-2])
-        voltage_str = lines[2].split()[1]
-        voltage = int(voltage[:-1])
-        lines = lines[6:]
-        t = []
-        v = []
-        for l in lines:
-            try:
-                timestamp, value = l.split(' ')
-                t.append(int(timestamp))
-                v.append(float(value))
-            except ValueError:
-                raise MonsoonError(err_msg)
         return MonsoonData(v, t, hz, voltage)
 
     @staticmethod
@@ -496,9 +549,21 @@ class MonsoonData:
         with open(file_path, 'r') as f:
             data_strs = f.read().split(MonsoonData.delimiter)
             for data_str in data_strs:
-                results.append(MonsoonData.from_string(data_str))
+                # The file ends with a delimiter, leaving an empty string.
+                if data_str.strip():
+                    results.append(MonsoonData.from_string(data_str))
         return results
 
+    def _get_data_points_sum(self):
+        """Gets the sum of the data points used in calculations.
+
+        The sum is only calculated once, until the offset changes, since
+        average_current, total_charge and total_power all need it.
+        """
+        if self._data_points_sum is None:
+            self._data_points_sum = math.fsum(self.data_points)
+        return self._data_points_sum
+
     def _validate_data(self):
         """Verifies that the data points contained in the class are valid.
         """
@@ -517,8 +582,9 @@ class MonsoonData:
             new_offset: The new offset.
         """
         self.offset = new_offset
-        self.data_points = self._data_points[self.offset:]
-        self.timestamps = self._timestamps[self.offset:]
+        self._offset_data_points = tuple(self._data_points[self.offset:])
+        self._offset_timestamps = tuple(self._timestamps[self.offset:])
+        self._data_points_sum = None
 
     def get_data_with_timestamps(self):
         """Returns the data points with timestamps.
@@ -541,13 +607,20 @@ class MonsoonData:
         Returns:
             A list of average current values.
         """
-        history_deque = collections.deque()
+        # Keep a running sum of the last n data points instead of summing the
+        # whole window again for every data point.
+        data_points = self.data_points
+        window_sum = 0
         averages = []
-        for d in self.data_points:
-            history_deque.appendleft(d)
-            if len(history_deque) > n:
-                history_deque.pop()
-            avg = sum(history_deque) / len(history_deque)
+        for i, d in enumerate(data_points):
+            window_sum += d
+            if i >= n:
+                window_sum -= data_points[i - n]
+            if i % n == n - 1:
+                # Sum the window exactly every n data points, so the rounding
+                # errors of the running sum don't pile up over a long run.
+                window_sum = math.fsum(data_points[i - n + 1:i + 1])
+            avg = window_sum / min(i + 1, n)
             averages.append(round(avg, self.lr))
         return averages
 
@@ -680,11 +753,15 @@ class Monsoon:
         # This is the error accumulator in a variation of Bresenham's
         # algorithm.
         emitted = offset = 0
-        collected = []
-        # past n samples for rolling average
-        history_deque = collections.deque()
-        current_values = []
-        timestamps = []
+        # Raw and output samples are kept in typed arrays rather than lists,
+        # so long measurements don't hold a float object per sample.
+        collected = array.array('d')
+        # Index of the first raw sample in "collected" not consumed yet.
+        # Consumed samples are only dropped when more data is collected, so
+        # consuming does not copy the rest of the list every time.
+        consumed = 0
+        current_values = array.array('d')
+        timestamps = array.array('q')
 
         try:
             last_flush = time.time()
@@ -692,19 +769,22 @@ class Monsoon:
                 # The number of raw samples to consume before emitting the next
                 # output
                 need = int((native_hz - offset + sample_hz - 1) / sample_hz)
-                if need > len(collected):     # still need more input samples
+                if need > len(collected) - consumed:
+                    # still need more input samples
                     samples = self.mon.CollectData()
                     if not samples:
                         break
+                    del collected[:consumed]
+                    consumed = 0
                     collected.extend(samples)
                 else:
                     # Have enough data, generate output samples.
                     # Adjust for consuming 'need' input samples.
                     offset += need * sample_hz
+                    this_sample = sum(
+                        collected[consumed:consumed + need]) / need
                     # maybe multiple, if sample_hz > native_hz
                     while offset >= native_hz:
-                        # TODO(angli): Optimize "collected" operations.
-                        this_sample = sum(collected[:need]) / need
                         this_time = int(time.time())
                         timestamps.append(this_time)
                         if live:
@@ -713,7 +793,7 @@ class Monsoon:
                         sys.stdout.flush()
                         offset -= native_hz
                         emitted += 1 # adjust for emitting 1 output sample
-                    collected = collected[need:]
+                    consumed += need
                     now = time.time()
                     if now - last_flush >= 0.99: # flush every second
                         sys.stdout.flush()
@@ -769,8 +849,13 @@ class Monsoon:
 
     @utils.timeout(15)
     def _wait_for_device(self, ad):
-        while ad.serial not in android_device.list_adb_devices():
-            pass
+        while True:
+            # Polling for the device to come back, so a cached device list
+            # would only delay noticing it.
+            android_device.invalidate_device_cache()
+            if ad.serial in android_device.list_adb_devices():
+                break
+            time.sleep(DEVICE_POLL_INTERVAL)
         ad.adb.wait_for_device()
 
     def execute_sequence_and_measure(self, step_funcs, hz, duration, offset_sec=20, *args, **kwargs):
@@ -15,6 +15,9 @@
 #   limitations under the License.
 
 from acts.controllers.android_device import AndroidDevice
+from acts.controllers.android_device import mark_devices_active
+from acts.controllers.android_device import mark_devices_inactive
+from acts.controllers.android_device import teardown_all_forwards
 from acts.controllers.adb import is_port_available
 from acts.controllers.adb import get_available_host_port
 import acts.controllers.native as native
@@ -29,15 +32,20 @@ ACTS_CONTROLLER_REFERENCE_NAME = "native_android_devices"
 
 def create(configs, logger):
     ads = get_instances(configs, logger)
+    mark_devices_active(ads)
     for ad in ads:
         try:
+            ad.root_adb()
             ad.get_droid()
         except:
             logger.exception("Failed to start sl4n on %s" % ad.serial)
     return ads
 
 def destroy(ads):
-    pass
+    mark_devices_inactive(ads)
+    teardown_all_forwards(ads)
+    for ad in ads:
+        ad.adb.close()
 
 def get_instances(serials, logger=None):
     """Create AndroidDevice instances from a list of serials.
@@ -59,10 +67,6 @@ class NativeAndroidDeviceError(Exception):
 
 class NativeAndroidDevice(AndroidDevice):
 
-    def __del__(self):
-        if self.h_port:
-            self.adb.forward("--remove tcp:%d" % self.h_port)
-
     def get_droid(self, handle_event=True):
         """Create an sl4n connection to the device.
 
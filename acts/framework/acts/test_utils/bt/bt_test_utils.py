@@ -595,11 +595,11 @@ def pair_pri_to_sec(pri_droid, sec_droid):
     # Enable discovery on sec_droid so that pri_droid can find it.
     # The timeout here is based on how much time it would take for two devices
     # to pair with each other once pri_droid starts seeing devices.
+    target_address = sec_droid.bluetoothGetLocalAddress()
     log.info(
         "Bonding device {} to {}".format(pri_droid.bluetoothGetLocalAddress(),
-                                         sec_droid.bluetoothGetLocalAddress()))
+                                         target_address))
     sec_droid.bluetoothMakeDiscoverable(DEFAULT_TIMEOUT)
-    target_address = sec_droid.bluetoothGetLocalAddress()
     log.debug("Starting paring helper on each device")
     pri_droid.bluetoothStartPairingHelper()
     sec_droid.bluetoothStartPairingHelper()
@@ -610,11 +610,9 @@ def pair_pri_to_sec(pri_droid, sec_droid):
     log.info("Verifying devices are bonded")
     while time.time() < end_time:
         bonded_devices = pri_droid.bluetoothGetBondedDevices()
-        bonded = False
-        for d in bonded_devices:
-            if d['address'] == target_address:
-                log.info("Successfully bonded to device")
-                return True
+        if any(d['address'] == target_address for d in bonded_devices):
+            log.info("Successfully bonded to device")
+            return True
     # Timed out trying to bond.
     log.info("Failed to bond devices.")
     return False
@@ -639,23 +637,19 @@ def connect_pri_to_sec(log, pri_droid, sec_droid, profiles_set):
                 profile, supported_profiles))
             return False
 
-    # First check that devices are bonded.
-    paired = False
-    for paired_device in pri_droid.droid.bluetoothGetBondedDevices():
-        if paired_device['address'] == \
-            sec_droid.bluetoothGetLocalAddress():
-            paired = True
-            break
-
-    if not paired:
+    # First check that devices are bonded. Get the address of sec_droid once
+    # instead of with an rpc call per bonded device.
+    sec_address = sec_droid.bluetoothGetLocalAddress()
+    bonded_addresses = set(
+        d['address'] for d in pri_droid.droid.bluetoothGetBondedDevices())
+    if sec_address not in bonded_addresses:
         log.info("{} not paired to {}".format(pri_droid.droid.getBuildSerial(),
                                               sec_droid.getBuildSerial()))
         return False
 
     # Now try to connect them, the following call will try to initiate all
     # connections.
-    pri_droid.droid.bluetoothConnectBonded(sec_droid.bluetoothGetLocalAddress(
-    ))
+    pri_droid.droid.bluetoothConnectBonded(sec_address)
 
     profile_connected = set()
     log.info("Profiles to be connected {}".format(profiles_set))
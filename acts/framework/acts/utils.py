@@ -255,7 +255,7 @@ def rand_ascii_str(length):
 
 
 # Thead/Process related functions.
-def concurrent_exec(func, param_list):
+def concurrent_exec(func, param_list, max_workers=None):
     """Executes a function with different parameters pseudo-concurrently.
 
     This is basically a map function. Each element (should be an iterable) in
@@ -266,13 +266,20 @@ def concurrent_exec(func, param_list):
         func: The function that parforms a task.
         param_list: A list of iterables, each being a set of params to be
             passed into the function.
+        max_workers: The max number of threads to use. By default, every
+            execution gets its own thread, since the tasks are expected to
+            spend their time waiting on IO, e.g. adb commands.
 
     Returns:
         A list of return values from each function execution. If an execution
         caused an exception, the exception object will be the corresponding
         result.
     """
-    with concurrent.futures.ThreadPoolExecutor(max_workers=30) as executor:
+    param_list = list(param_list)
+    if max_workers is None:
+        max_workers = max(len(param_list), 1)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
         # Start the load operations and mark each future with its params
         future_to_params = {executor.submit(func, *p): p for p in param_list}
         return_vals = []
@@ -324,7 +331,7 @@ def require_sl4a(android_devices):
         assert ad.droid, msg
 
 
-def start_standing_subprocess(cmd):
+def start_standing_subprocess(cmd, stdout_file=None):
     """Starts a non-blocking subprocess that is going to continue running after
     this function returns.
 
@@ -333,17 +340,28 @@ def start_standing_subprocess(cmd):
     necessary in case users pass in pipe commands.
 
     Args:
-        cmd: Command to start the subprocess with.
+        cmd: Command to start the subprocess with. A string is run through
+            the shell, a list of args is executed directly.
+        stdout_file: If specified, the path of a file the stdout of the
+            subprocess is appended to, instead of being piped.
 
     Returns:
         The subprocess that got started.
     """
-    p = subprocess.Popen(cmd,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True,
-                         preexec_fn=os.setpgrp)
-    return p
+    shell = isinstance(cmd, str)
+    if stdout_file is None:
+        return subprocess.Popen(cmd,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                shell=shell,
+                                preexec_fn=os.setpgrp)
+    with open(stdout_file, "ab") as f:
+        # The subprocess gets its own copy of the file descriptor.
+        return subprocess.Popen(cmd,
+                                stdout=f,
+                                stderr=subprocess.PIPE,
+                                shell=shell,
+                                preexec_fn=os.setpgrp)
 
 
 def stop_standing_subprocess(p, kill_signal=signal.SIGTERM):
@@ -14,11 +14,55 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import io
+import mock
 import socket
+import subprocess
+import time
 import unittest
 
+from acts import utils
 from acts.controllers import adb
 
+_real_popen = subprocess.Popen
+
+def mock_adb_shell_popen(cmd, **kwargs):
+    """Starts a local sh in place of the persistent "adb shell" process."""
+    if cmd == ["adb", "-s", "1", "shell", "-T"]:
+        return _real_popen(["sh"], **kwargs)
+    return _real_popen(cmd, **kwargs)
+
+def mock_adb_pty_shell_popen(cmd, **kwargs):
+    """Fakes an "adb shell" process that got a PTY, which echoes what is
+    written to it after a prompt and ends lines with "\\r\\n".
+    """
+    proc = mock.MagicMock()
+    proc.poll.return_value = None
+    proc.stdin = io.BytesIO()
+    proc.stdout = io.BytesIO(b"shell@sprout:/ $ echo __ACTS_EOF_0__\r\n"
+                             b"__ACTS_EOF_0__\r\n"
+                             b"shell@sprout:/ $ ")
+    return proc
+
+def mock_adb_exited_shell_popen(cmd, **kwargs):
+    """Fakes an "adb shell" process that exited right away, e.g. because the
+    device was offline for a moment.
+    """
+    proc = mock.MagicMock()
+    proc.poll.return_value = 1
+    proc.stdin = io.BytesIO()
+    proc.stdout = io.BytesIO(b"")
+    return proc
+
+def mock_adb_features_unknown(cmd, **kwargs):
+    """Fakes a host adb that does not know the features command."""
+    if cmd[-1] == "get-state":
+        return b"device\n"
+    raise subprocess.CalledProcessError(1, cmd)
+
+MOCK_FEATURES = b"shell_v2\ncmd\n"
+MOCK_LEGACY_FEATURES = b"cmd\n"
+
 class ActsAdbTest(unittest.TestCase):
     """This test class has unit tests for the implementation of everything
     under acts.controllers.adb.
@@ -39,5 +83,175 @@ class ActsAdbTest(unittest.TestCase):
         finally:
             test_s.close()
 
+    @mock.patch('subprocess.check_output', return_value=MOCK_FEATURES)
+    @mock.patch('subprocess.Popen', side_effect=mock_adb_shell_popen)
+    def test_persistent_shell_run(self, mock_popen, mock_check_output):
+        shell = adb.PersistentAdbShell("1")
+        try:
+            self.assertEqual(shell.run("echo hello"), b"hello\n")
+            self.assertEqual(shell.run("printf hello"), b"hello")
+            with self.assertRaises(adb.AdbError):
+                shell.run("false")
+            self.assertEqual(shell.run("echo again"), b"again\n")
+            # All the commands are run in one process.
+            self.assertEqual(mock_popen.call_count, 1)
+        finally:
+            shell.close()
+
+    @mock.patch('subprocess.check_output', return_value=MOCK_FEATURES)
+    @mock.patch('subprocess.Popen', side_effect=mock_adb_shell_popen)
+    def test_persistent_shell_restart(self, mock_popen, mock_check_output):
+        shell = adb.PersistentAdbShell("1")
+        try:
+            shell.run("echo hello")
+            shell.close()
+            self.assertFalse(shell.is_alive)
+            self.assertEqual(shell.run("echo hello"), b"hello\n")
+            self.assertEqual(mock_popen.call_count, 2)
+        finally:
+            shell.close()
+
+    @mock.patch('subprocess.check_output', return_value=MOCK_FEATURES)
+    @mock.patch('subprocess.Popen', side_effect=mock_adb_shell_popen)
+    def test_shell_special_chars_use_one_shot(self, mock_popen,
+                                              mock_check_output):
+        proxy = adb.AdbProxy("1", persistent_shell=True)
+        proxy._exec_cmd = mock.MagicMock(return_value=b"one-shot")
+        try:
+            self.assertEqual(proxy.shell("echo hello"), b"hello\n")
+            self.assertEqual(proxy.shell("ps | grep sl4a"), b"one-shot")
+            proxy._exec_cmd.assert_called_once_with(
+                "adb -s 1 shell ps | grep sl4a", timeout=None)
+        finally:
+            proxy.close()
+
+    @mock.patch('subprocess.check_output', return_value=MOCK_FEATURES)
+    @mock.patch('subprocess.Popen', side_effect=mock_adb_pty_shell_popen)
+    def test_persistent_shell_rejects_pty(self, mock_popen,
+                                          mock_check_output):
+        shell = adb.PersistentAdbShell("1")
+        with self.assertRaises(OSError):
+            shell.run("getprop sys.boot_completed")
+        # The command was never written to the PTY session.
+        self.assertFalse(shell.is_supported)
+        self.assertFalse(shell.is_alive)
+        with self.assertRaises(OSError):
+            shell.run("getprop sys.boot_completed")
+        self.assertEqual(mock_popen.call_count, 1)
+
+    @mock.patch('subprocess.check_output', return_value=MOCK_FEATURES)
+    def test_persistent_shell_exited_is_transient(self, mock_check_output):
+        shell = adb.PersistentAdbShell("1")
+        try:
+            with mock.patch('subprocess.Popen',
+                            side_effect=mock_adb_exited_shell_popen):
+                with self.assertRaises(OSError):
+                    shell.run("echo hello")
+            # The shell is tried again, and works once the device is back.
+            self.assertTrue(shell.is_supported)
+            with mock.patch('subprocess.Popen',
+                            side_effect=mock_adb_shell_popen):
+                self.assertEqual(shell.run("echo hello"), b"hello\n")
+        finally:
+            shell.close()
+
+    @mock.patch('subprocess.check_output',
+                side_effect=mock_adb_features_unknown)
+    def test_persistent_shell_features_unknown_cached(self,
+                                                      mock_check_output):
+        shell = adb.PersistentAdbShell("1")
+        self.assertFalse(shell.is_supported)
+        self.assertFalse(shell.is_supported)
+        mock_check_output.assert_has_calls([
+            mock.call(["adb", "-s", "1", "features"]),
+            mock.call(["adb", "-s", "1", "get-state"])])
+        self.assertEqual(mock_check_output.call_count, 2)
+
+    @mock.patch('subprocess.check_output',
+                side_effect=subprocess.CalledProcessError(1, "adb"))
+    def test_persistent_shell_features_offline_not_cached(self,
+                                                          mock_check_output):
+        shell = adb.PersistentAdbShell("1")
+        self.assertFalse(shell.is_supported)
+        # The device was not online, so the features are asked for again.
+        mock_check_output.side_effect = None
+        mock_check_output.return_value = MOCK_FEATURES
+        self.assertTrue(shell.is_supported)
+
+    @mock.patch('subprocess.check_output', return_value=MOCK_FEATURES)
+    @mock.patch('subprocess.Popen', side_effect=mock_adb_pty_shell_popen)
+    def test_shell_pty_session_uses_one_shot(self, mock_popen,
+                                             mock_check_output):
+        proxy = adb.AdbProxy("1", persistent_shell=True)
+        proxy._exec_cmd = mock.MagicMock(return_value=b"1\n")
+        self.assertEqual(proxy.getprop("sys.boot_completed"), "1")
+        self.assertEqual(proxy.getprop("sys.boot_completed"), "1")
+        self.assertEqual(proxy._exec_cmd.call_count, 2)
+        proxy._exec_cmd.assert_called_with(
+            "adb -s 1 shell getprop sys.boot_completed", timeout=None)
+        # The PTY session is only tried once.
+        self.assertEqual(mock_popen.call_count, 1)
+
+    @mock.patch('subprocess.check_output', return_value=MOCK_LEGACY_FEATURES)
+    @mock.patch('subprocess.Popen')
+    def test_shell_without_shell_v2_uses_one_shot(self, mock_popen,
+                                                  mock_check_output):
+        proxy = adb.AdbProxy("1", persistent_shell=True)
+        proxy._exec_cmd = mock.MagicMock(return_value=b"1\n")
+        self.assertEqual(proxy.getprop("sys.boot_completed"), "1")
+        self.assertEqual(proxy.getprop("ro.build.product"), "1")
+        self.assertFalse(mock_popen.called)
+        mock_check_output.assert_called_once_with(["adb", "-s", "1",
+                                                   "features"])
+
+    @mock.patch('subprocess.check_output', return_value=MOCK_FEATURES)
+    @mock.patch('subprocess.Popen', side_effect=mock_adb_shell_popen)
+    def test_shell_one_shot(self, mock_popen, mock_check_output):
+        proxy = adb.AdbProxy("1", persistent_shell=True)
+        proxy._exec_cmd = mock.MagicMock(return_value=b"one-shot")
+        self.assertEqual(proxy.shell("bugreportz", one_shot=True),
+                         b"one-shot")
+        proxy._exec_cmd.assert_called_once_with("adb -s 1 shell bugreportz",
+                                                timeout=None)
+        self.assertFalse(mock_popen.called)
+
+    def test_exec_cmd_timeout_kills_command(self):
+        procs = []
+        def popen(cmd, **kwargs):
+            procs.append(_real_popen(cmd, **kwargs))
+            return procs[-1]
+        proxy = adb.AdbProxy("1")
+        start = time.time()
+        with mock.patch('subprocess.Popen', side_effect=popen):
+            with self.assertRaises(subprocess.TimeoutExpired):
+                # The shell forks sleep instead of exec'ing it, like it does
+                # for the adb client, so killing only the shell isn't enough.
+                proxy._exec_cmd("sleep 10; true", timeout=0.1)
+        self.assertLess(time.time() - start, 5)
+        # The command was killed and reaped instead of left running.
+        self.assertEqual(len(procs), 1)
+        self.assertIsNotNone(procs[0].returncode)
+
+    def test_exec_cmd_interrupted_by_utils_timeout(self):
+        proxy = adb.AdbProxy("1")
+        start = time.time()
+        with self.assertRaises(utils.TimeoutError):
+            utils.timeout(1)(proxy._exec_cmd)("sleep 10; true")
+        self.assertLess(time.time() - start, 5)
+
+    def test_shell_timeout_uses_one_shot(self):
+        proxy = adb.AdbProxy("1", persistent_shell=True)
+        proxy._exec_cmd = mock.MagicMock(return_value=b"")
+        proxy.shell("getprop sys.boot_completed", timeout=5)
+        proxy._exec_cmd.assert_called_once_with(
+            "adb -s 1 shell getprop sys.boot_completed", timeout=5)
+
+    def test_getprop(self):
+        proxy = adb.AdbProxy("1")
+        proxy._exec_cmd = mock.MagicMock(return_value=b"sprout\r\n")
+        self.assertEqual(proxy.getprop("ro.build.product"), "sprout")
+        proxy._exec_cmd.assert_called_once_with(
+            "adb -s 1 shell getprop ro.build.product", timeout=None)
+
 if __name__ == "__main__":
    unittest.main()
\ No newline at end of file
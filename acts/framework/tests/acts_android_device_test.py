@@ -22,6 +22,7 @@ import tempfile
 import unittest
 
 from acts import base_test
+from acts.controllers import adb
 from acts.controllers import android_device
 
 # Mock log path for a test run.
@@ -73,17 +74,18 @@ class MockAdbProxy():
     def __init__(self, serial):
         self.serial = serial
 
-    def shell(self, params):
+    def shell(self, params, one_shot=False, timeout=None):
         if params == "id -u":
             return b"root"
-        if (params == "getprop | grep ro.build.product" or
-            params == "getprop | grep ro.product.name"):
-            return b"[ro.build.product]: [FakeModel]"
-        elif params == "getprop sys.boot_completed":
-            return b"1"
         elif params == "bugreportz":
             return b'OK:/path/bugreport.zip\n'
 
+    def getprop(self, prop_name):
+        if prop_name in ("ro.build.product", "ro.product.name"):
+            return "FakeModel"
+        elif prop_name == "sys.boot_completed":
+            return "1"
+
     def bugreport(self, params):
         expected = os.path.join(logging.log_path,
                                 "AndroidDevice%s" % self.serial, "BugReports",
@@ -110,6 +112,8 @@ class ActsAndroidDeviceTest(unittest.TestCase):
         """Creates a temp dir to be used by tests in this test class.
         """
         self.tmp_dir = tempfile.mkdtemp()
+        android_device.invalidate_device_cache()
+        android_device._active_ads.clear()
 
     def tearDown(self):
         """Removes the temp dir.
@@ -128,6 +132,7 @@ class ActsAndroidDeviceTest(unittest.TestCase):
         actual_ads = android_device.create(pick_all_token, logging)
         for actual, expected in zip(actual_ads, get_mock_ads(5)):
             self.assertEqual(actual.serial, expected.serial)
+        self.assertEqual(android_device._active_ads, set(actual_ads))
 
     def test_create_with_empty_config(self):
         expected_msg = android_device.ANDROID_DEVICE_EMPTY_CONFIG_MSG
@@ -141,6 +146,115 @@ class ActsAndroidDeviceTest(unittest.TestCase):
                                      expected_msg):
             android_device.create("HAHA", logging)
 
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    @mock.patch.object(android_device, "list_adb_devices",
+                       return_value=["1", "2"])
+    def test_create_with_missing_devices(self, mock_list_adb_devices,
+                                         MockAdbProxy):
+        """Verifies create reports every configured device that is not
+        attached at once.
+        """
+        expected_msg = (r"Android device\(s\) 5, 6 specified in config but "
+                        "not attached.")
+        with self.assertRaisesRegexp(android_device.DoesNotExistError,
+                                     expected_msg):
+            android_device.create(["1", "5", "6"], get_mock_logger())
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    def test_list_adb_devices_cached(self, MockAdbProxy):
+        """Verifies list_adb_devices reuses the result of "adb devices" until
+        the device cache is invalidated.
+        """
+        devices = MockAdbProxy.return_value.devices
+        devices.return_value = b"List of devices attached\n1\tdevice\n"
+        self.assertEqual(android_device.list_adb_devices(), ["1"])
+        self.assertEqual(android_device.list_adb_devices(), ["1"])
+        self.assertEqual(devices.call_count, 1)
+        android_device.invalidate_device_cache()
+        self.assertEqual(android_device.list_adb_devices(), ["1"])
+        self.assertEqual(devices.call_count, 2)
+
+    def test_parse_device_list(self):
+        """Verifies only serials in the requested state are parsed out of adb
+        and fastboot output.
+        """
+        out = (b"List of devices attached\r\n1\tdevice\r\n2\toffline\n"
+               b"  3\tdevice \n4\tfastboot\nbogus line\n\n")
+        self.assertEqual(android_device._parse_device_list(out, "device"),
+                         ["1", "3"])
+        self.assertEqual(android_device._parse_device_list(out, "fastboot"),
+                         ["4"])
+        self.assertEqual(android_device._parse_device_list(b"", "device"), [])
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    @mock.patch('acts.controllers.adb.list_occupied_adb_ports',
+                return_value=[5000, 5001])
+    def test_teardown_all_forwards_batched(self, mock_list_ports,
+                                           MockAdbProxy):
+        """Verifies all port forwarding is removed with one adb call if the
+        devices own every occupied port.
+        """
+        ads = get_mock_ads(3)
+        ads[0].h_port = 5000
+        ads[1].h_port = 5001
+        android_device.teardown_all_forwards(ads)
+        MockAdbProxy.return_value.forward.assert_called_once_with(
+            "--remove-all")
+        for ad in ads:
+            self.assertFalse(ad.adb.forward.called)
+            self.assertIsNone(ad.h_port)
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    @mock.patch('acts.controllers.adb.list_occupied_adb_ports',
+                return_value=[5000, 5001, 6000])
+    def test_teardown_all_forwards_per_device(self, mock_list_ports,
+                                              MockAdbProxy):
+        """Verifies port forwarding is removed per device if other ports are
+        forwarded by the adb server.
+        """
+        ads = get_mock_ads(2)
+        ads[0].h_port = 5000
+        ads[1].h_port = 5001
+        android_device.teardown_all_forwards(ads)
+        self.assertFalse(MockAdbProxy.return_value.forward.called)
+        ads[0].adb.forward.assert_called_once_with("--remove tcp:5000")
+        ads[1].adb.forward.assert_called_once_with("--remove tcp:5001")
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    @mock.patch('acts.controllers.adb.list_occupied_adb_ports',
+                return_value=[5000, 5001])
+    def test_teardown_all_forwards_other_testbed_active(self, mock_list_ports,
+                                                        MockAdbProxy):
+        """Verifies port forwarding is removed per device while another
+        testbed is active, even if the devices own every occupied port, since
+        the other testbed may be about to forward a port.
+        """
+        ads = get_mock_ads(2)
+        ads[0].h_port = 5000
+        ads[1].h_port = 5001
+        android_device.mark_devices_active(get_mock_ads(1))
+        android_device.teardown_all_forwards(ads)
+        self.assertFalse(MockAdbProxy.return_value.forward.called)
+        ads[0].adb.forward.assert_called_once_with("--remove tcp:5000")
+        ads[1].adb.forward.assert_called_once_with("--remove tcp:5001")
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    @mock.patch('acts.controllers.adb.list_occupied_adb_ports',
+                return_value=[5000, 5001])
+    def test_destroy_unmarks_active_devices(self, mock_list_ports,
+                                            MockAdbProxy):
+        """Verifies destroy marks its devices inactive, so the batched
+        removal of port forwarding can be used for them.
+        """
+        ads = get_mock_ads(2)
+        ads[0].h_port = 5000
+        ads[1].h_port = 5001
+        android_device.mark_devices_active(ads)
+        android_device.destroy(ads)
+        self.assertEqual(android_device._active_ads, set())
+        MockAdbProxy.return_value.forward.assert_called_once_with(
+            "--remove-all")
+
     def test_get_device_success_with_serial(self):
         ads = get_mock_ads(5)
         expected_serial = 0
@@ -189,9 +303,25 @@ class ActsAndroidDeviceTest(unittest.TestCase):
         ads[2].clean_up = mock.MagicMock()
         with self.assertRaisesRegexp(android_device.AndroidDeviceError, msg):
             android_device._start_services_on_ads(ads)
-        ads[0].clean_up.assert_called_once_with()
-        ads[1].clean_up.assert_called_once_with()
-        ads[2].clean_up.assert_called_once_with()
+        ads[0].clean_up.assert_called_once_with(remove_forward=False)
+        ads[1].clean_up.assert_called_once_with(remove_forward=False)
+        ads[2].clean_up.assert_called_once_with(remove_forward=False)
+
+    def test_start_services_on_ads_concurrently(self):
+        """Makes sure that services are started on every AndroidDevice object
+        even if an earlier one fails, since they are started concurrently.
+        """
+        msg = "Some error happened."
+        ads = get_mock_ads(3)
+        ads[0].start_services = mock.MagicMock(
+            side_effect=android_device.AndroidDeviceError(msg))
+        ads[1].start_services = mock.MagicMock()
+        ads[2].start_services = mock.MagicMock()
+        with self.assertRaisesRegexp(android_device.AndroidDeviceError, msg):
+            android_device._start_services_on_ads(ads)
+        for ad in ads:
+            self.assertEqual(ad.start_services.call_count, 1)
+            ad.clean_up.assert_called_once_with(remove_forward=False)
 
     # Tests for android_device.AndroidDevice class.
     # These tests mock out any interaction with the OS and real android device
@@ -213,6 +343,109 @@ class ActsAndroidDeviceTest(unittest.TestCase):
                                    "AndroidDevice%s" % mock_serial)
         self.assertEqual(ad.log_path, expected_lp)
 
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    @mock.patch('acts.controllers.fastboot.FastbootProxy')
+    def test_AndroidDevice_reboot(self, MockFastbootProxy, MockAdbProxy):
+        """Verifies AndroidDevice.reboot switches adb to root before it
+        restarts adb logcat and sl4a on the device.
+        """
+        MockFastbootProxy.return_value.devices.return_value = b""
+        ad = android_device.AndroidDevice(serial=1, logger=get_mock_logger())
+        ad.adb_logcat_process = "process"
+        ad.wait_for_boot_completion = mock.MagicMock()
+        ad.stop_adb_logcat = mock.MagicMock()
+        ad.terminate_all_sessions = mock.MagicMock()
+        ad.root_adb = mock.MagicMock()
+        ad.start_adb_logcat = mock.MagicMock(
+            side_effect=lambda: self.assertTrue(ad.root_adb.called))
+        mock_droid, mock_ed = mock.MagicMock(), mock.MagicMock()
+        ad.get_droid = mock.MagicMock(return_value=(mock_droid, mock_ed))
+        self.assertEqual(ad.reboot(), (mock_droid, mock_ed))
+        MockAdbProxy.return_value.reboot.assert_called_once_with()
+        self.assertEqual(ad.start_adb_logcat.call_count, 1)
+        self.assertEqual(mock_ed.start.call_count, 1)
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    @mock.patch('acts.controllers.adb.get_available_host_port',
+                return_value=5000)
+    def test_AndroidDevice_get_droid_forwards_once(self, mock_get_port,
+                                                   MockAdbProxy):
+        """Verifies get_droid only sets up adb port forwarding again after
+        the existing forwarding has been removed.
+        """
+        ad = android_device.AndroidDevice(serial=1, logger=get_mock_logger())
+        ad.start_new_session = mock.MagicMock()
+        ad.get_droid(handle_event=False)
+        ad.get_droid(handle_event=False)
+        MockAdbProxy.return_value.tcp_forward.assert_called_once_with(5000,
+                                                                      8080)
+        ad.clean_up()
+        ad.get_droid(handle_event=False)
+        self.assertEqual(MockAdbProxy.return_value.tcp_forward.call_count, 2)
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    def test_AndroidDevice_context_manager(self, MockAdbProxy):
+        """Verifies AndroidDevice cleans itself up when used as a context
+        manager.
+        """
+        mock_adb = MockAdbProxy.return_value
+        with android_device.AndroidDevice(serial=1, host_port=5000,
+                                          logger=get_mock_logger()) as ad:
+            self.assertFalse(mock_adb.close.called)
+        mock_adb.forward.assert_called_once_with("--remove tcp:5000")
+        self.assertEqual(mock_adb.close.call_count, 1)
+        self.assertIsNone(ad.h_port)
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    def test_AndroidDevice_root_adb_when_already_root(self, MockAdbProxy):
+        """Verifies AndroidDevice does not switch adb to root mode on
+        instantiation, and root_adb does nothing if adb is already root.
+        """
+        mock_adb = MockAdbProxy.return_value
+        mock_adb.shell.return_value = b"0\n"
+        ad = android_device.AndroidDevice(serial=1, logger=get_mock_logger())
+        ad.root_adb()
+        mock_adb.shell.assert_called_once_with("id -u")
+        self.assertFalse(mock_adb.root.called)
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    def test_AndroidDevice_is_adb_root_cached(self, MockAdbProxy):
+        """Verifies is_adb_root only queries the device again after adb has
+        been switched to root mode.
+        """
+        mock_adb = MockAdbProxy.return_value
+        mock_adb.shell.return_value = b"2000\n"
+        ad = android_device.AndroidDevice(serial=1, logger=get_mock_logger())
+        self.assertFalse(ad.is_adb_root)
+        self.assertFalse(ad.is_adb_root)
+        self.assertEqual(mock_adb.shell.call_count, 1)
+        mock_adb.shell.return_value = b"0\n"
+        ad.root_adb()
+        self.assertTrue(mock_adb.root.called)
+        self.assertTrue(ad.is_adb_root)
+        self.assertEqual(mock_adb.shell.call_count, 2)
+
+    @mock.patch('acts.controllers.adb.AdbProxy')
+    def test_AndroidDevice_has_bugreportz_cached(self, MockAdbProxy):
+        """Verifies has_bugreportz caches a definite answer, and probes the
+        device again after other adb errors.
+        """
+        mock_adb = MockAdbProxy.return_value
+        ad = android_device.AndroidDevice(serial=1, logger=get_mock_logger())
+        # adb flakiness is not an answer.
+        mock_adb.shell.side_effect = adb.AdbError("flaky", ret_code=1)
+        self.assertFalse(ad.has_bugreportz)
+        mock_adb.shell.side_effect = adb.AdbError(
+            "not found", ret_code=adb.SHELL_COMMAND_NOT_FOUND)
+        self.assertFalse(ad.has_bugreportz)
+        self.assertFalse(ad.has_bugreportz)
+        self.assertEqual(mock_adb.shell.call_count, 2)
+        ad = android_device.AndroidDevice(serial=1, logger=get_mock_logger())
+        mock_adb.shell.side_effect = None
+        self.assertTrue(ad.has_bugreportz)
+        self.assertTrue(ad.has_bugreportz)
+        self.assertEqual(mock_adb.shell.call_count, 3)
+
     @mock.patch('acts.controllers.adb.AdbProxy', return_value=MockAdbProxy(1))
     @mock.patch('acts.utils.create_dir')
     @mock.patch('acts.utils.exe_cmd')
@@ -262,9 +495,9 @@ class ActsAndroidDeviceTest(unittest.TestCase):
                                     "AndroidDevice%s" % ad.serial,
                                     "adblog,fakemodel,%s.txt" % ad.serial)
         creat_dir_mock.assert_called_with(os.path.dirname(expected_log_path))
-        adb_cmd = 'adb -s %s logcat -v threadtime  >> %s'
-        start_proc_mock.assert_called_with(adb_cmd % (ad.serial,
-                                                      expected_log_path))
+        adb_cmd = ["adb", "-s", str(ad.serial), "logcat", "-v", "threadtime"]
+        start_proc_mock.assert_called_with(adb_cmd,
+                                           stdout_file=expected_log_path)
         self.assertEqual(ad.adb_logcat_file_path, expected_log_path)
         expected_msg = ("Android device .* already has an adb logcat thread "
                         "going on. Cannot start another one.")
@@ -319,5 +552,85 @@ class ActsAndroidDeviceTest(unittest.TestCase):
         # Stops adb logcat.
         ad.stop_adb_logcat()
 
+    @mock.patch('acts.controllers.adb.AdbProxy', return_value=MockAdbProxy(1))
+    @mock.patch('acts.utils.start_standing_subprocess', return_value="process")
+    @mock.patch('acts.utils.stop_standing_subprocess')
+    @mock.patch('acts.logger.get_log_line_timestamp',
+                return_value="02-29 14:02:23.000")
+    def test_AndroidDevice_cat_adb_log_whole_file(self,
+                                                  mock_timestamp_getter,
+                                                  stop_proc_mock,
+                                                  start_proc_mock,
+                                                  MockAdbProxy):
+        """Verifies that AndroidDevice.cat_adb_log copies the whole adb log
+        file if all of it is within the given time range.
+        """
+        ad = android_device.AndroidDevice(serial=1, logger=get_mock_logger())
+        ad.start_adb_logcat()
+        ad.log_path = os.path.join(self.tmp_dir, ad.log_path)
+        mock_adb_log_path = os.path.join(ad.log_path, "adblog,%s,%s.txt" %
+                                         (ad.model, ad.serial))
+        with open(mock_adb_log_path, 'w') as f:
+            f.write(MOCK_ADB_LOGCAT.rstrip("\n"))
+        ad.cat_adb_log("some_test", "02-29 14:02:19.000")
+        cat_file_path = os.path.join(ad.log_path,
+                                     "AdbLogExcerpts",
+                                     ("some_test,02-29 14:02:19.000,%s,%s.txt"
+                                     ) % (ad.model, ad.serial))
+        with open(cat_file_path, 'r') as f:
+            actual_cat = f.read()
+        self.assertEqual(actual_cat, MOCK_ADB_LOGCAT)
+        ad.stop_adb_logcat()
+
+    @mock.patch('acts.controllers.adb.AdbProxy', return_value=MockAdbProxy(1))
+    @mock.patch('acts.utils.start_standing_subprocess', return_value="process")
+    @mock.patch('acts.utils.stop_standing_subprocess')
+    @mock.patch('acts.logger.get_log_line_timestamp',
+                return_value="02-29 14:02:23.000")
+    def test_AndroidDevice_cat_adb_log_whole_file_untimestamped_lines(
+            self, mock_timestamp_getter, stop_proc_mock, start_proc_mock,
+            MockAdbProxy):
+        """Verifies that AndroidDevice.cat_adb_log drops the lines without a
+        timestamp when all of the adb log is within the given time range, the
+        same way it does when only part of it is.
+        """
+        ad = android_device.AndroidDevice(serial=1, logger=get_mock_logger())
+        ad.start_adb_logcat()
+        ad.log_path = os.path.join(self.tmp_dir, ad.log_path)
+        mock_adb_log_path = os.path.join(ad.log_path, "adblog,%s,%s.txt" %
+                                         (ad.model, ad.serial))
+        with open(mock_adb_log_path, 'w') as f:
+            f.write("--------- beginning of main\n" + MOCK_ADB_LOGCAT)
+        ad.cat_adb_log("some_test", "02-29 14:02:19.000")
+        cat_file_path = os.path.join(ad.log_path,
+                                     "AdbLogExcerpts",
+                                     ("some_test,02-29 14:02:19.000,%s,%s.txt"
+                                     ) % (ad.model, ad.serial))
+        with open(cat_file_path, 'r') as f:
+            actual_cat = f.read()
+        self.assertEqual(actual_cat, MOCK_ADB_LOGCAT)
+        ad.stop_adb_logcat()
+
+    def test_copy_timestamped_lines(self):
+        """Verifies that only the lines with a timestamp are copied, also when
+        lines span the chunks the file is read in, and that the last line gets
+        a newline.
+        """
+        lines = MOCK_ADB_LOGCAT.encode("utf-8")
+        content = (b"--------- beginning of main\n" + lines +
+                   b"--------- beginning of system\n\n" + lines.rstrip(b"\n"))
+        expected = lines + lines
+        for buffer_size in (1 << 20, 7):
+            with mock.patch.object(android_device,
+                                   "ADB_LOGCAT_READ_BUFFER_SIZE",
+                                   buffer_size):
+                with tempfile.TemporaryFile() as src:
+                    with tempfile.TemporaryFile() as dst:
+                        src.write(content + b"02-29 appended later\n")
+                        android_device._copy_timestamped_lines(src, dst,
+                                                               len(content))
+                        dst.seek(0)
+                        self.assertEqual(dst.read(), expected)
+
 if __name__ == "__main__":
    unittest.main()
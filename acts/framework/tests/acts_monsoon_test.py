@@ -0,0 +1,99 @@
+#!/usr/bin/env python3.4
+#
+#   Copyright 2016 - The Android Open Source Project
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import array
+import os
+import shutil
+import tempfile
+import unittest
+
+from acts.controllers import monsoon
+
+class ActsMonsoonTest(unittest.TestCase):
+    """This test class has unit tests for the implementation of everything
+    under acts.controllers.monsoon.
+    """
+
+    def setUp(self):
+        """Creates a temp dir to be used by tests in this test class.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Removes the temp dir.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_monsoon_data_text_file_round_trip(self):
+        """Verifies that MonsoonData objects saved with save_to_text_file are
+        loaded back by from_text_file with the same hz, voltage and data.
+        """
+        md1 = monsoon.MonsoonData([0.1, 0.25, 0.5, 0.125],
+                                  [1000, 1001, 1002, 1003], 1, 4.2, offset=1)
+        md1.tag = "First measurement"
+        md2 = monsoon.MonsoonData([1.5, 2.000001, 0.000003],
+                                  [2000, 2001, 2002], 5000, 3.8)
+        md3 = monsoon.MonsoonData([0.333333], [3000], 100, 4)
+        expected = [md1, md2, md3]
+        file_path = os.path.join(self.tmp_dir, "monsoon", "data.txt")
+        monsoon.MonsoonData.save_to_text_file(expected, file_path)
+        actual = monsoon.MonsoonData.from_text_file(file_path)
+        self.assertEqual(len(actual), len(expected))
+        for a, e in zip(actual, expected):
+            self.assertEqual(a.hz, e.hz)
+            self.assertEqual(a.voltage, e.voltage)
+            # Only the data points after the offset are saved.
+            self.assertEqual(list(a.data_points), list(e.data_points))
+            self.assertEqual(list(a.timestamps), list(e.timestamps))
+            self.assertEqual(a.average_current, e.average_current)
+
+    def test_monsoon_data_points_read_only(self):
+        """Verifies the data points of a MonsoonData object cannot be changed
+        behind the back of the cached calculations, whatever sequence type
+        they were created from.
+        """
+        md = monsoon.MonsoonData(array.array('d', [0.1, 0.2, 0.3]),
+                                 array.array('q', [1000, 1001, 1002]), 10, 4.2)
+        loaded = monsoon.MonsoonData.from_string(str(md))
+        for m in (md, loaded):
+            self.assertIsInstance(m.data_points, tuple)
+            self.assertIsInstance(m.timestamps, tuple)
+            with self.assertRaises(AttributeError):
+                m.data_points = [1, 2, 3]
+            with self.assertRaises(TypeError):
+                m.data_points[0] = 1
+        self.assertEqual(md.average_current, 200)
+        md.update_offset(1)
+        self.assertEqual(md.data_points, (0.2, 0.3))
+        self.assertEqual(md.timestamps, (1001, 1002))
+        self.assertEqual(md.average_current, 250)
+
+    def test_monsoon_data_from_string_invalid(self):
+        md = monsoon.MonsoonData([0.1, 0.2], [1000, 1001], 10, 4.2)
+        lines = str(md).split("\n")
+        invalid_strs = (
+            "",
+            "\n".join(lines[:6]),
+            "\n".join(lines[:2] + ["Voltage: V."] + lines[3:]),
+            "\n".join(lines[:4] + ["2 samples taken at"] + lines[5:]),
+            "\n".join(lines + ["1002 0.3 extra"]),
+            "\n".join(lines + ["1002 not_a_number"]))
+        for s in invalid_strs:
+            with self.assertRaises(monsoon.MonsoonError):
+                monsoon.MonsoonData.from_string(s)
+
+if __name__ == "__main__":
+   unittest.main()
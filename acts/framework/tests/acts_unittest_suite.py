@@ -20,6 +20,7 @@ import unittest
 import acts_adb_test
 import acts_android_device_test
 import acts_base_class_test
+import acts_monsoon_test
 import acts_records_test
 import acts_test_runner_test
 
@@ -29,6 +30,7 @@ def compile_suite():
         acts_base_class_test.ActsBaseClassTest,
         acts_test_runner_test.ActsTestRunnerTest,
         acts_android_device_test.ActsAndroidDeviceTest,
+        acts_monsoon_test.ActsMonsoonTest,
         acts_records_test.ActsRecordsTest
     ]
 
@@ -17,8 +17,6 @@
 This script shows simple examples of how to get started with bluetooth low energy testing in acts.
 """
 
-import pprint
-
 from acts.controllers import android_devices
 from acts.test_utils.bt.BluetoothBaseTest import BluetoothBaseTest
 from acts.test_utils.bt.bt_test_utils import adv_succ
@@ -102,8 +100,7 @@ class BleExamplesTest(BluetoothBaseTest):
         event_name = scan_result.format(scan_callback)
         try:
             event = self.scn_ed.pop_event(event_name, self.default_timeout)
-            self.log.info("Found scan result: {}".format(pprint.pformat(
-                event)))
+            self.log.info("Found scan result: %s", event)
         except Exception:
             self.log.info("Didn't find any scan results.")
         return True
@@ -14,6 +14,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import concurrent.futures
 import queue
 
 import acts.base_test as base_test
@@ -27,9 +28,27 @@ ON_MATCH = "WifiNanSessionOnMatch"
 ON_MESSAGE_RX = "WifiNanSessionOnMessageReceived"
 ON_MESSAGE_TX_FAIL = "WifiNanSessionOnMessageSendFail"
 ON_MESSAGE_TX_OK = "WifiNanSessionOnMessageSendSuccess"
+# Matches the events telling whether a message was sent.
+ON_MESSAGE_TX_REGEX = '%s|%s' % (ON_MESSAGE_TX_FAIL, ON_MESSAGE_TX_OK)
+
+def run_concurrently(*funcs):
+    """Calls functions concurrently, e.g. rpcs on different devices.
+
+    Args:
+        funcs: The functions to call, without args.
+
+    Returns:
+        A list of the return values of the functions, in the same order.
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(funcs)) as executor:
+        futures = [executor.submit(f) for f in funcs]
+        return [f.result() for f in futures]
 
 class WifiNanManagerTest(base_test.BaseTestClass):
     msg_id = 10
+    SUB2PUB_MSG = "How are you doing?"
+    PUB2SUB_MSG = "Doing ok - thanks!"
 
     def __init__(self, controllers):
         base_test.BaseTestClass.__init__(self, controllers)
@@ -48,9 +67,12 @@ class WifiNanManagerTest(base_test.BaseTestClass):
             "subscribe_data",
             "subscribe_settings"
         )
-        self.unpack_userparams(required_params)
-
-    def setup_test(self):
+        opt_params = ("nan_max_msg_tx_tries",)
+        self.unpack_userparams(required_params, opt_params,
+                               nan_max_msg_tx_tries=10)
+        asserts.assert_true(self.nan_max_msg_tx_tries >= 1,
+                            "nan_max_msg_tx_tries must be at least 1, got %s" %
+                            self.nan_max_msg_tx_tries)
         assert wutils.wifi_toggle_state(self.publisher, True)
         assert wutils.wifi_toggle_state(self.subscriber, True)
 
@@ -60,26 +82,29 @@ class WifiNanManagerTest(base_test.BaseTestClass):
 
     def reliable_tx(self, device, peer, msg):
         num_tries = 0
-        max_num_tries = 10
-        events_regex = '%s|%s' % (ON_MESSAGE_TX_FAIL, ON_MESSAGE_TX_OK)
+        max_num_tries = self.nan_max_msg_tx_tries
         self.msg_id = self.msg_id + 1
+        msg_id = self.msg_id
+        droid = device.droid
+        ed = device.ed
+        log = self.log
 
         while True:
             try:
                 num_tries += 1
-                device.droid.wifiNanSendMessage(peer, msg, self.msg_id)
-                events = device.ed.pop_events(events_regex, 30)
+                droid.wifiNanSendMessage(peer, msg, msg_id)
+                events = ed.pop_events(ON_MESSAGE_TX_REGEX, 30)
                 for event in events:
-                    self.log.info('%s: %s' % (event['name'], event['data']))
-                    if event['data']['messageId'] != self.msg_id:
+                    log.info('%s: %s', event['name'], event['data'])
+                    if event['data']['messageId'] != msg_id:
                         continue
                     if event['name'] == ON_MESSAGE_TX_OK:
                         return True
-                    if num_tries == max_num_tries:
-                        self.log.info("Max number of retries reached")
+                    if num_tries >= max_num_tries:
+                        log.info("Max number of retries reached")
                         return False
             except queue.Empty:
-                self.log.info('Timed out while waiting for %s' % events_regex)
+                log.info('Timed out while waiting for %s', ON_MESSAGE_TX_REGEX)
                 return False
 
     def test_nan_base_test(self):
@@ -99,64 +124,65 @@ class WifiNanManagerTest(base_test.BaseTestClass):
           * P sends a message to S, confirming that sent successfully
           * S waits for a message and confirms that received (uncorrupted)
         """
-        self.publisher.droid.wifiNanEnable(self.config_request1)
-        self.subscriber.droid.wifiNanEnable(self.config_request2)
-
-        sub2pub_msg = "How are you doing?"
-        pub2sub_msg = "Doing ok - thanks!"
+        # The devices are independent, so don't wait for one rpc to finish
+        # before making the other. Events are buffered by each device's event
+        # dispatcher, so they can still be waited for one after the other.
+        run_concurrently(
+            lambda: self.publisher.droid.wifiNanEnable(self.config_request1),
+            lambda: self.subscriber.droid.wifiNanEnable(self.config_request2))
 
         try:
             event = self.publisher.ed.pop_event(ON_IDENTITY_CHANGED, 30)
-            self.log.info('%s: %s' % (ON_IDENTITY_CHANGED, event['data']))
+            self.log.info('%s: %s', ON_IDENTITY_CHANGED, event['data'])
         except queue.Empty:
             asserts.fail('Timed out while waiting for %s on Publisher' %
                       ON_IDENTITY_CHANGED)
-        self.log.debug(event)
 
         try:
             event = self.subscriber.ed.pop_event(ON_IDENTITY_CHANGED, 30)
-            self.log.info('%s: %s' % (ON_IDENTITY_CHANGED, event['data']))
+            self.log.info('%s: %s', ON_IDENTITY_CHANGED, event['data'])
         except queue.Empty:
             asserts.fail('Timed out while waiting for %s on Subscriber' %
                       ON_IDENTITY_CHANGED)
-        self.log.debug(event)
 
-        self.publisher.droid.wifiNanPublish(self.publish_data,
-                                            self.publish_settings, 0)
-        self.subscriber.droid.wifiNanSubscribe(self.subscribe_data,
-                                               self.subscribe_settings, 0)
+        run_concurrently(
+            lambda: self.publisher.droid.wifiNanPublish(
+                self.publish_data, self.publish_settings, 0),
+            lambda: self.subscriber.droid.wifiNanSubscribe(
+                self.subscribe_data, self.subscribe_settings, 0))
 
         try:
             event = self.subscriber.ed.pop_event(ON_MATCH, 30)
-            self.log.info('%s: %s' % (ON_MATCH, event['data']))
+            self.log.info('%s: %s', ON_MATCH, event['data'])
         except queue.Empty:
             asserts.fail('Timed out while waiting for %s on Subscriber' % ON_MATCH)
-        self.log.debug(event)
 
         asserts.assert_true(self.reliable_tx(self.subscriber,
                                           event['data']['peerId'],
-                                          sub2pub_msg),
+                                          self.SUB2PUB_MSG),
                          "Failed to transmit from subscriber")
 
         try:
             event = self.publisher.ed.pop_event(ON_MESSAGE_RX, 10)
-            self.log.info('%s: %s' % (ON_MESSAGE_RX, event['data']))
-            asserts.assert_true(event['data']['messageAsString'] == sub2pub_msg,
-                             "Subscriber -> publisher message corrupted")
+            self.log.info('%s: %s', ON_MESSAGE_RX, event['data'])
+            asserts.assert_true(
+                event['data']['messageAsString'] == self.SUB2PUB_MSG,
+                "Subscriber -> publisher message corrupted")
         except queue.Empty:
             asserts.fail('Timed out while waiting for %s on publisher' %
                       ON_MESSAGE_RX)
 
         asserts.assert_true(self.reliable_tx(self.publisher,
                                           event['data']['peerId'],
-                                          pub2sub_msg),
+                                          self.PUB2SUB_MSG),
                          "Failed to transmit from publisher")
 
         try:
             event = self.subscriber.ed.pop_event(ON_MESSAGE_RX, 10)
-            self.log.info('%s: %s' % (ON_MESSAGE_RX, event['data']))
-            asserts.assert_true(event['data']['messageAsString'] == pub2sub_msg,
-                             "Publisher -> subscriber message corrupted")
+            self.log.info('%s: %s', ON_MESSAGE_RX, event['data'])
+            asserts.assert_true(
+                event['data']['messageAsString'] == self.PUB2SUB_MSG,
+                "Publisher -> subscriber message corrupted")
         except queue.Empty:
             asserts.fail('Timed out while waiting for %s on subscriber' %
                       ON_MESSAGE_RX)